@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from sqladmin import Admin
-from .views import ImageView
+from .views import ImageView, ModelLimitView
 from .auth import authentication_backend
 from app.db.base import engine
 
@@ -9,4 +9,5 @@ def attach_admin_panel(application: FastAPI):
     admin = Admin(application, engine, authentication_backend=authentication_backend)
 
     admin.add_view(ImageView)
+    admin.add_view(ModelLimitView)
 
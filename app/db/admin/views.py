@@ -1,4 +1,4 @@
-from app.db.tables import Image
+from app.db.tables import Image, ModelLimit
 from sqladmin import ModelView
 
 
@@ -8,3 +8,7 @@ class ImageView(ModelView, model=Image):
     column_sortable_list = [Image.created_at, Image.updated_at]
     column_default_sort = [(Image.created_at, True)]
 
+
+class ModelLimitView(ModelView, model=ModelLimit):
+    column_list = [ModelLimit.model, ModelLimit.limit, ModelLimit.updated_at]
+    form_columns = [ModelLimit.model, ModelLimit.limit]
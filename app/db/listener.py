@@ -0,0 +1,59 @@
+from typing import Callable
+
+import asyncpg
+from loguru import logger
+
+from app.db.create import settings
+
+IMAGE_QUEUE_CHANNEL = 'image_queue'
+IMAGE_DONE_CHANNEL = 'image_done'
+CALLBACK_CHANNEL = 'image_callbacks'
+
+
+class PGListener:
+    """Fans Postgres NOTIFY messages out to in-process callbacks.
+
+    A single dedicated asyncpg connection is kept open for LISTEN, so the
+    pooled SQLAlchemy connections are never pinned by subscriptions.
+    """
+
+    def __init__(self):
+        self._connection: asyncpg.Connection | None = None
+        self._callbacks: dict[str, list[Callable[[str], None]]] = {}
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, connection, pid, channel, payload):
+        for callback in self._callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.exception(e)
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def ensure_connected(self):
+        """Open the LISTEN connection if it is missing or was dropped"""
+        if self.is_connected:
+            return
+        try:
+            self._connection = await asyncpg.connect(
+                user=settings.postgres_user, database=settings.postgres_db,
+                password=settings.postgres_password, host=settings.postgres_host
+            )
+            for channel in self._callbacks:
+                await self._connection.add_listener(channel, self._dispatch)
+        except Exception as e:
+            logger.warning(f'Postgres LISTEN connection is unavailable: {e}')
+            await self.stop()
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+pg_listener = PGListener()
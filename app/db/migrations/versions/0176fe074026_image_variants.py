@@ -0,0 +1,24 @@
+"""image variants
+
+Revision ID: 0176fe074026
+Revises: 6e874d83b217
+Create Date: 2026-10-18 04:30:08.858897
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '0176fe074026'
+down_revision = '6e874d83b217'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('variants', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'variants')
@@ -0,0 +1,33 @@
+"""image expires at timezone
+
+Revision ID: 12e17d99394a
+Revises: 732e744553a2
+Create Date: 2026-10-18 04:49:59.436830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '12e17d99394a'
+down_revision = '732e744553a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.alter_column('images', 'expires_at',
+               existing_type=postgresql.TIMESTAMP(),
+               type_=sa.DateTime(timezone=True),
+               existing_nullable=True,
+               # Expiries were stored as naive UTC
+               postgresql_using="expires_at AT TIME ZONE 'UTC'")
+
+
+def downgrade() -> None:
+    op.alter_column('images', 'expires_at',
+               existing_type=sa.DateTime(timezone=True),
+               type_=postgresql.TIMESTAMP(),
+               existing_nullable=True,
+               postgresql_using="expires_at AT TIME ZONE 'UTC'")
@@ -0,0 +1,37 @@
+"""add image queue indexes
+
+Revision ID: 1efd0f8f2705
+Revises: 556fe2c76574
+Create Date: 2026-10-18 04:02:42.863131
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1efd0f8f2705'
+down_revision = '556fe2c76574'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_images_unsended_created_at', 'images', ['created_at'],
+        unique=False, postgresql_where=sa.text('status IS NULL')
+    )
+    op.create_index(
+        'ix_images_queued_created_at', 'images', ['created_at'],
+        unique=False, postgresql_where=sa.text("status = 'queued'")
+    )
+    op.create_index(
+        'ix_images_submitting_lease_expires_at', 'images', ['lease_expires_at'],
+        unique=False, postgresql_where=sa.text("status = 'submitting'")
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_images_submitting_lease_expires_at', table_name='images')
+    op.drop_index('ix_images_queued_created_at', table_name='images')
+    op.drop_index('ix_images_unsended_created_at', table_name='images')
@@ -0,0 +1,35 @@
+"""add early outputs
+
+Revision ID: 2db4634031d4
+Revises: 12e17d99394a
+Create Date: 2026-10-18 05:06:04.804345
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '2db4634031d4'
+down_revision = '12e17d99394a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('early_outputs',
+    sa.Column('request_id', sa.String(), nullable=False),
+    sa.Column('output', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_early_outputs_id'), 'early_outputs', ['id'], unique=False)
+    op.create_index(op.f('ix_early_outputs_request_id'), 'early_outputs', ['request_id'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_early_outputs_request_id'), table_name='early_outputs')
+    op.drop_index(op.f('ix_early_outputs_id'), table_name='early_outputs')
+    op.drop_table('early_outputs')
@@ -0,0 +1,43 @@
+"""add image callbacks
+
+Revision ID: 45fe92f09388
+Revises: 72378a7a4eda
+Create Date: 2026-10-18 04:23:43.800456
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '45fe92f09388'
+down_revision = '72378a7a4eda'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('image_callbacks',
+    sa.Column('image_id', sa.Uuid(), nullable=False),
+    sa.Column('url', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.ForeignKeyConstraint(['image_id'], ['images.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_image_callbacks_id'), 'image_callbacks', ['id'], unique=False)
+    op.create_index(op.f('ix_image_callbacks_image_id'), 'image_callbacks', ['image_id'], unique=False)
+    op.create_index('ix_image_callbacks_pending_next_attempt_at', 'image_callbacks', ['next_attempt_at'], unique=False, postgresql_where=sa.text('next_attempt_at IS NOT NULL'))
+    op.add_column('images', sa.Column('callback_url', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'callback_url')
+    op.drop_index('ix_image_callbacks_pending_next_attempt_at', table_name='image_callbacks', postgresql_where=sa.text('next_attempt_at IS NOT NULL'))
+    op.drop_index(op.f('ix_image_callbacks_image_id'), table_name='image_callbacks')
+    op.drop_index(op.f('ix_image_callbacks_id'), table_name='image_callbacks')
+    op.drop_table('image_callbacks')
@@ -0,0 +1,28 @@
+"""add image submit lease
+
+Revision ID: 556fe2c76574
+Revises: 3e27d832ef03
+Create Date: 2026-10-18 04:01:54.003729
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '556fe2c76574'
+down_revision = '3e27d832ef03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE imagestatus ADD VALUE IF NOT EXISTS 'submitting'")
+    op.add_column('images', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.execute("UPDATE images SET status = NULL WHERE status = 'submitting'")
+    op.drop_column('images', 'lease_expires_at')
+    # Postgres can not drop a value from an enum type, 'submitting' stays unused
@@ -0,0 +1,32 @@
+"""add image mirror
+
+Revision ID: 6e874d83b217
+Revises: 45fe92f09388
+Create Date: 2026-10-18 04:27:21.569218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e874d83b217'
+down_revision = '45fe92f09388'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('file_key', sa.String(), nullable=True))
+    op.add_column('images', sa.Column('file_content_type', sa.String(), nullable=True))
+    op.add_column('images', sa.Column('mirror_attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('images', sa.Column('mirror_lease_expires_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_images_unmirrored_created_at', 'images', ['created_at'], unique=False, postgresql_where=sa.text("status = 'finished' AND file_key IS NULL"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_images_unmirrored_created_at', table_name='images', postgresql_where=sa.text("status = 'finished' AND file_key IS NULL"))
+    op.drop_column('images', 'mirror_lease_expires_at')
+    op.drop_column('images', 'mirror_attempts')
+    op.drop_column('images', 'file_content_type')
+    op.drop_column('images', 'file_key')
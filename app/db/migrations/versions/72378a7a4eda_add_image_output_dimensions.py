@@ -0,0 +1,28 @@
+"""add image output dimensions
+
+Revision ID: 72378a7a4eda
+Revises: e2c9ed8d298e
+Create Date: 2026-10-18 04:17:49.958971
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '72378a7a4eda'
+down_revision = 'e2c9ed8d298e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('images', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('images', sa.Column('seed', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'seed')
+    op.drop_column('images', 'height')
+    op.drop_column('images', 'width')
@@ -0,0 +1,26 @@
+"""image expires at
+
+Revision ID: 732e744553a2
+Revises: 889dad4e08d0
+Create Date: 2026-10-18 04:35:51.523538
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '732e744553a2'
+down_revision = '889dad4e08d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_images_unsended_expires_at', 'images', ['expires_at'], unique=False, postgresql_where=sa.text('status IS NULL AND expires_at IS NOT NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_images_unsended_expires_at', table_name='images', postgresql_where=sa.text('status IS NULL AND expires_at IS NOT NULL'))
+    op.drop_column('images', 'expires_at')
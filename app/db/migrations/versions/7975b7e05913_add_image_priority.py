@@ -0,0 +1,29 @@
+"""add image priority
+
+Revision ID: 7975b7e05913
+Revises: a79cb746f50d
+Create Date: 2026-10-18 04:05:23.612380
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7975b7e05913'
+down_revision = 'a79cb746f50d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('priority', sa.Integer(), server_default='0', nullable=False))
+    op.create_index(
+        'ix_images_unsended_priority', 'images', [sa.text('priority DESC'), 'created_at'],
+        unique=False, postgresql_where=sa.text('status IS NULL')
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_images_unsended_priority', table_name='images')
+    op.drop_column('images', 'priority')
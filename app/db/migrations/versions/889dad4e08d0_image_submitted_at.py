@@ -0,0 +1,26 @@
+"""image submitted at
+
+Revision ID: 889dad4e08d0
+Revises: 0176fe074026
+Create Date: 2026-10-18 04:33:13.700481
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '889dad4e08d0'
+down_revision = '0176fe074026'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('submitted_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_images_submitted_at'), 'images', ['submitted_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_images_submitted_at'), table_name='images')
+    op.drop_column('images', 'submitted_at')
@@ -0,0 +1,30 @@
+"""add image batches
+
+Revision ID: 945c968120cc
+Revises: 7975b7e05913
+Create Date: 2026-10-18 04:06:48.779861
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '945c968120cc'
+down_revision = '7975b7e05913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('batch_id', sa.Uuid(), nullable=True))
+    op.add_column('images', sa.Column('output_index', sa.Integer(), server_default='0', nullable=False))
+    op.create_index(op.f('ix_images_batch_id'), 'images', ['batch_id'], unique=False)
+    op.create_index(op.f('ix_images_request_id'), 'images', ['request_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_images_request_id'), table_name='images')
+    op.drop_index(op.f('ix_images_batch_id'), table_name='images')
+    op.drop_column('images', 'output_index')
+    op.drop_column('images', 'batch_id')
@@ -0,0 +1,42 @@
+"""add image model and model limits
+
+Revision ID: a79cb746f50d
+Revises: 1efd0f8f2705
+Create Date: 2026-10-18 04:03:29.621001
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a79cb746f50d'
+down_revision = '1efd0f8f2705'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('model_limits',
+    sa.Column('model', sa.String(), nullable=False),
+    sa.Column('limit', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('model')
+    )
+    op.create_index(op.f('ix_model_limits_id'), 'model_limits', ['id'], unique=False)
+    op.add_column('images', sa.Column('model', sa.String(), nullable=True))
+    op.execute(
+        "UPDATE images SET model = CASE WHEN resource_image_url IS NULL "
+        "THEN 'fal-ai/flux/schnell' "
+        "ELSE 'fal-ai/stable-diffusion-v3-medium/image-to-image' END"
+    )
+    op.alter_column('images', 'model', nullable=False)
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'model')
+    op.drop_index(op.f('ix_model_limits_id'), table_name='model_limits')
+    op.drop_table('model_limits')
@@ -0,0 +1,41 @@
+"""add image result cache
+
+Revision ID: aa96e2985035
+Revises: 945c968120cc
+Create Date: 2026-10-18 04:08:48.976887
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aa96e2985035'
+down_revision = '945c968120cc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('image_caches',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('image_url', sa.String(), nullable=False),
+    sa.Column('hits', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_hit_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_image_caches_id'), 'image_caches', ['id'], unique=False)
+    op.create_index(op.f('ix_image_caches_key'), 'image_caches', ['key'], unique=True)
+    op.create_index(op.f('ix_image_caches_last_hit_at'), 'image_caches', ['last_hit_at'], unique=False)
+    op.add_column('images', sa.Column('cache_key', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'cache_key')
+    op.drop_index(op.f('ix_image_caches_last_hit_at'), table_name='image_caches')
+    op.drop_index(op.f('ix_image_caches_key'), table_name='image_caches')
+    op.drop_index(op.f('ix_image_caches_id'), table_name='image_caches')
+    op.drop_table('image_caches')
@@ -0,0 +1,28 @@
+"""add image leader
+
+Revision ID: cf12b7a6690f
+Revises: aa96e2985035
+Create Date: 2026-10-18 04:10:21.735579
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cf12b7a6690f'
+down_revision = 'aa96e2985035'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('leader_id', sa.Uuid(), nullable=True))
+    op.create_index(op.f('ix_images_leader_id'), 'images', ['leader_id'], unique=False)
+    op.create_index(op.f('ix_images_cache_key'), 'images', ['cache_key'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_images_cache_key'), table_name='images')
+    op.drop_index(op.f('ix_images_leader_id'), table_name='images')
+    op.drop_column('images', 'leader_id')
@@ -0,0 +1,39 @@
+"""add source uploads
+
+Revision ID: e2c9ed8d298e
+Revises: cf12b7a6690f
+Create Date: 2026-10-18 04:13:59.894377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c9ed8d298e'
+down_revision = 'cf12b7a6690f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('source_uploads',
+    sa.Column('digest', sa.String(), nullable=False),
+    sa.Column('image_url', sa.String(), nullable=False),
+    sa.Column('hits', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_hit_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_source_uploads_digest'), 'source_uploads', ['digest'], unique=True)
+    op.create_index(op.f('ix_source_uploads_id'), 'source_uploads', ['id'], unique=False)
+    op.create_index(op.f('ix_source_uploads_last_hit_at'), 'source_uploads', ['last_hit_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_source_uploads_last_hit_at'), table_name='source_uploads')
+    op.drop_index(op.f('ix_source_uploads_id'), table_name='source_uploads')
+    op.drop_index(op.f('ix_source_uploads_digest'), table_name='source_uploads')
+    op.drop_table('source_uploads')
@@ -6,11 +6,14 @@ from enum import Enum
 from sqlalchemy import bindparam
 from sqlalchemy import CheckConstraint
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Table
 from sqlalchemy import text
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import Mapped as M
 from sqlalchemy.orm import mapped_column as column
@@ -38,16 +41,96 @@ class ImageStatus(Enum):
     finished = 'finished'
     queued = 'queued'
     error = 'error'
+    submitting = 'submitting'
 
 
 class Image(BaseMixin, Base):
     status: M[ImageStatus | None] = column(default=None)
     comment: M[str | None] = column(nullable=True)
-    request_id: M[str | None] = column(nullable=True)
+    request_id: M[str | None] = column(nullable=True, index=True)
     image_url: M[str | None] = column(nullable=True)
     app_bundle: M[str]
     user_id: M[str]
     prompt: M[str]
     image_size: M[str]
     resource_image_url: M[str | None]
+    model: M[str]
+    priority: M[int] = column(default=0, server_default='0')
+    batch_id: M[UUID | None] = column(index=True)
+    output_index: M[int] = column(default=0, server_default='0')
+    cache_key: M[str | None] = column(index=True)
+    leader_id: M[UUID | None] = column(index=True)
+    lease_expires_at: M[dt.datetime | None]
+    submitted_at: M[dt.datetime | None] = column(index=True)
+    expires_at: M[dt.datetime | None] = column(DateTime(timezone=True))
+    width: M[int | None]
+    height: M[int | None]
+    seed: M[int | None]
+    callback_url: M[str | None]
+    file_key: M[str | None]
+    file_content_type: M[str | None]
+    mirror_attempts: M[int] = column(default=0, server_default='0')
+    mirror_lease_expires_at: M[dt.datetime | None]
+    variants: M[dict | None] = column(JSONB)
 
+    __table_args__ = (
+        Index('ix_images_unsended_created_at', 'created_at', postgresql_where=text('status IS NULL')),
+        Index(
+            'ix_images_unsended_priority', text('priority DESC'), 'created_at',
+            postgresql_where=text('status IS NULL')
+        ),
+        Index('ix_images_queued_created_at', 'created_at', postgresql_where=text("status = 'queued'")),
+        Index(
+            'ix_images_unsended_expires_at', 'expires_at',
+            postgresql_where=text('status IS NULL AND expires_at IS NOT NULL')
+        ),
+        Index(
+            'ix_images_submitting_lease_expires_at', 'lease_expires_at',
+            postgresql_where=text("status = 'submitting'")
+        ),
+        Index(
+            'ix_images_unmirrored_created_at', 'created_at',
+            postgresql_where=text("status = 'finished' AND file_key IS NULL")
+        ),
+    )
+
+
+
+class ModelLimit(BaseMixin, Base):
+    model: M[str] = column(unique=True)
+    limit: M[int]
+
+
+class ImageCache(BaseMixin, Base):
+    key: M[str] = column(unique=True, index=True)
+    image_url: M[str]
+    hits: M[int] = column(default=0, server_default='0')
+    last_hit_at: M[dt.datetime] = column(server_default=func.now(), index=True)
+
+
+class SourceUpload(BaseMixin, Base):
+    digest: M[str] = column(unique=True, index=True)
+    image_url: M[str]
+    hits: M[int] = column(default=0, server_default='0')
+    last_hit_at: M[dt.datetime] = column(server_default=func.now(), index=True)
+
+
+# A fal webhook delivered before the submit result of its images was stored
+class EarlyOutput(BaseMixin, Base):
+    request_id: M[str] = column(unique=True, index=True)
+    output: M[dict] = column(JSONB)
+
+
+class ImageCallback(BaseMixin, Base):
+    image_id: M[UUID] = column(ForeignKey('images.id', ondelete='CASCADE'), index=True)
+    url: M[str]
+    attempts: M[int] = column(default=0, server_default='0')
+    next_attempt_at: M[dt.datetime | None] = column(server_default=func.now())
+    last_error: M[str | None]
+
+    __table_args__ = (
+        Index(
+            'ix_image_callbacks_pending_next_attempt_at', 'next_attempt_at',
+            postgresql_where=text('next_attempt_at IS NOT NULL')
+        ),
+    )
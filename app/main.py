@@ -9,9 +9,25 @@ from loguru import logger
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from contextlib import asynccontextmanager
+import datetime as dt
 
 from app.db.admin import attach_admin_panel
-from app.services.image import ImageService
+from app.db.listener import CALLBACK_CHANNEL, IMAGE_DONE_CHANNEL, IMAGE_QUEUE_CHANNEL, pg_listener
+from app.services.callbacks import callback_dispatcher, callbacks
+from app.services.dispatcher import dispatcher
+from app.services.image import ImageService, queue_settings
+from app.services.mirror import mirror, mirror_dispatcher
+from app.services.notifier import completions
+from app.services.rate_limit import rate_limiter
+from app.services.storage import storage
+from app.services.task_cache import task_cache
+from app.services.image_processing import shutdown_pool
+from app.services.result_cache import result_cache_settings
+from app.services.source_cache import source_cache_settings
+from app.services.write_behind import status_writes
+from app.repositories.fal import close_fal_client, get_fal_client
+from app.repositories.image_cache import ImageCacheRepository
+from app.repositories.source_upload import SourceUploadRepository
 
 
 class ProjectSettings(BaseSettings):
@@ -42,18 +58,69 @@ def register_cors(application):
     )
 
 
-@repeat_every(seconds=15)
-async def process_images_queue():
+@repeat_every(seconds=result_cache_settings.result_cache_evict_interval)
+async def evict_result_cache():
     try:
-        await ImageService.process_images_queue()
+        async with ImageCacheRepository() as repository:
+            evicted = await repository.evict(
+                dt.timedelta(seconds=result_cache_settings.result_cache_ttl_seconds),
+                result_cache_settings.result_cache_max_entries
+            )
+        logger.info(f'Evicted {evicted} result cache entries')
+    except Exception as e:
+        logger.exception(e)
+
+
+@repeat_every(seconds=result_cache_settings.result_cache_evict_interval)
+async def evict_source_cache():
+    try:
+        async with SourceUploadRepository() as repository:
+            evicted = await repository.evict(
+                dt.timedelta(seconds=source_cache_settings.source_cache_ttl_seconds),
+                source_cache_settings.source_cache_max_entries
+            )
+        logger.info(f'Evicted {evicted} source upload cache entries')
+    except Exception as e:
+        logger.exception(e)
+
+
+@repeat_every(seconds=queue_settings.reconcile_interval)
+async def reconcile_queued_images():
+    try:
+        await ImageService.reconcile_queued()
     except Exception as e:
         logger.exception(e)
 
 
 @asynccontextmanager
 async def lifespan(app):
-    await process_images_queue()
+    pg_listener.subscribe(IMAGE_QUEUE_CHANNEL, dispatcher.wake)
+    pg_listener.subscribe(IMAGE_DONE_CHANNEL, completions.notify)
+    pg_listener.subscribe(IMAGE_DONE_CHANNEL, task_cache.forget)
+    pg_listener.subscribe(CALLBACK_CHANNEL, callback_dispatcher.wake)
+    if storage is not None:
+        pg_listener.subscribe(IMAGE_DONE_CHANNEL, mirror_dispatcher.wake)
+    await pg_listener.ensure_connected()
+    get_fal_client()
+    dispatcher.start(ImageService.process_images_queue)
+    callback_dispatcher.start(callbacks.deliver_due)
+    if storage is not None:
+        mirror_dispatcher.start(mirror.mirror_finished)
+    await evict_result_cache()
+    await evict_source_cache()
+    await reconcile_queued_images()
     yield
+    await dispatcher.stop()
+    await status_writes.close()
+    await callback_dispatcher.stop()
+    await callbacks.close()
+    await mirror_dispatcher.stop()
+    await mirror.close()
+    await pg_listener.stop()
+    shutdown_pool()
+    await close_fal_client()
+    await task_cache.close()
+    await rate_limiter.close()
 
 
 def init_web_application():
@@ -1,15 +1,14 @@
 import os
-import io
-import hashlib
-import asyncio
 import fal_client
-from PIL import Image
-from aiohttp import ClientSession, MultipartWriter, ClientTimeout
+from fastapi import Depends
+from fastapi.params import Depends as DependsClass
+from typing import AsyncIterable
 from pydantic import ValidationError
 from loguru import logger
 from uuid import uuid4
 
-from app.schemas.ai import AIInputSchema, AIOutputSchema
+from app.repositories.fal import PooledFalClient, get_fal_client
+from app.schemas.ai import AIInputSchema, AIOutputSchema, AIModel
 
 token = os.getenv("API_TOKEN")
 
@@ -17,35 +16,44 @@ token = os.getenv("API_TOKEN")
 class AIRepository:
     API_WEBHOOK_BASEURL = os.getenv("API_WEBHOOK_BASEURL")
 
+    def __init__(self, client: PooledFalClient = Depends(get_fal_client)):
+        if isinstance(client, DependsClass):
+            client = get_fal_client()
+        self.client = client
+
     async def submit(self, schema: AIInputSchema, image_id: str) -> str:
         """Return the request_id"""
-        handler = await fal_client.submit_async(
-            "fal-ai/flux/schnell",
+        handler = await self.client.submit(
+            AIModel.flux_schnell.value,
             arguments=schema.model_dump(),
             webhook_url=(self.API_WEBHOOK_BASEURL + f"/image/{image_id}/webhook" if self.API_WEBHOOK_BASEURL is not None else None),
         )
         return handler.request_id
 
-    async def is_finished(self, request_id: str) -> bool:
-        status = await fal_client.status_async("fal-ai/flux/schnell", request_id, with_logs=True)
+    async def is_finished(self, model: str, request_id: str) -> bool:
+        status = await self.client.status(model, request_id)
         logger.debug(status)
-        return not isinstance(status, fal_client.InProgress)
+        return isinstance(status, fal_client.Completed)
+
+    async def cancel(self, model: str, request_id: str):
+        await self.client.cancel(model, request_id)
 
-    async def get_output(self, request_id: str) -> AIOutputSchema:
-        result = await fal_client.result_async("fal-ai/flux/schnell", request_id)
+    async def get_output(self, model: str, request_id: str) -> AIOutputSchema:
+        """Return the result of a finished request in the shape of the webhook body"""
+        result = await self.client.result(model, request_id)
         logger.debug(result)
-        return AIOutputSchema.model_validate(result)
+        return AIOutputSchema(request_id=request_id, status="OK", payload=result)
 
-    async def upload_image(self, image_body: io.BytesIO) -> str:
-        img = Image.open(image_body)
-        return await fal_client.upload_image_async(img)
+    async def upload_image(self, chunks: AsyncIterable[bytes], size: int, content_type: str) -> str:
+        """Stream the image bytes to fal storage as is and return the access url"""
+        return await self.client.upload_stream(chunks, size, content_type)
 
     async def submit_img2img(self, schema: AIInputSchema, image_url: str, image_id: str) -> str:
         """Return the request_id"""
         arguments = schema.model_dump()
         arguments["image_url"] = image_url
-        handler = await fal_client.submit_async(
-            "fal-ai/stable-diffusion-v3-medium/image-to-image",
+        handler = await self.client.submit(
+            AIModel.sd3_image_to_image.value,
             arguments=arguments,
             webhook_url=(self.API_WEBHOOK_BASEURL + f"/image/{image_id}/webhook" if self.API_WEBHOOK_BASEURL is not None else None),
         )
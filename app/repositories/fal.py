@@ -0,0 +1,85 @@
+from functools import cached_property
+from importlib.util import find_spec
+from typing import AsyncIterable
+from fal_client.client import AsyncClient, CDN_URL, USER_AGENT, _raise_for_status
+from pydantic_settings import BaseSettings
+import httpx
+
+
+class FalClientSettings(BaseSettings):
+    fal_max_connections: int = 100
+    fal_max_keepalive_connections: int = 20
+    fal_keepalive_expiry: float = 60
+    fal_connect_timeout: float = 10
+    fal_timeout: float = 120
+    fal_http2: bool = True
+
+
+fal_settings = FalClientSettings()
+
+
+class PooledFalClient(AsyncClient):
+    """fal client whose API and CDN connections are kept alive and reused by every call.
+
+    The stock client builds a new httpx client (and TLS connection) for every
+    upload. HTTP/2 is used when the h2 package is installed.
+    """
+
+    def _http_client(self, **kwargs) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(fal_settings.fal_timeout, connect=fal_settings.fal_connect_timeout),
+            limits=httpx.Limits(
+                max_connections=fal_settings.fal_max_connections,
+                max_keepalive_connections=fal_settings.fal_max_keepalive_connections,
+                keepalive_expiry=fal_settings.fal_keepalive_expiry
+            ),
+            http2=fal_settings.fal_http2 and find_spec("h2") is not None,
+            **kwargs
+        )
+
+    @cached_property
+    def _client(self) -> httpx.AsyncClient:
+        return self._http_client(headers={"Authorization": f"Key {self._get_key()}", "User-Agent": USER_AGENT})
+
+    @cached_property
+    def _cdn_client(self) -> httpx.AsyncClient:
+        # The CDN token expires, so it is sent per request instead of as a client header
+        return self._http_client(headers={"User-Agent": USER_AGENT})
+
+    async def upload_stream(self, chunks: AsyncIterable[bytes], size: int, content_type: str) -> str:
+        """Stream the data to the CDN and return the access url"""
+        token = await self._token_manager.get_token()
+        response = await self._cdn_client.post(
+            CDN_URL + "/files/upload",
+            content=chunks,
+            headers={
+                "Authorization": f"{token.token_type} {token.token}",
+                "Content-Type": content_type,
+                "Content-Length": str(size)
+            }
+        )
+        _raise_for_status(response)
+        return response.json()["access_url"]
+
+    async def aclose(self):
+        for name in ("_client", "_cdn_client"):
+            if name in self.__dict__:
+                await self.__dict__.pop(name).aclose()
+
+
+_fal_client: PooledFalClient | None = None
+
+
+def get_fal_client() -> PooledFalClient:
+    """Return the app scoped fal client, it is opened in the lifespan"""
+    global _fal_client
+    if _fal_client is None:
+        _fal_client = PooledFalClient(default_timeout=fal_settings.fal_timeout)
+    return _fal_client
+
+
+async def close_fal_client():
+    global _fal_client
+    if _fal_client is not None:
+        await _fal_client.aclose()
+        _fal_client = None
@@ -1,10 +1,26 @@
-from fastapi import Depends
+from fastapi import Depends, HTTPException
 from loguru import logger
-from uuid import uuid4
-from sqlalchemy import select, or_
+from uuid import uuid4, UUID
+from sqlalchemy import select, update, delete, or_, and_, func, case, cast, literal, values, column, Float, Integer, String, Uuid, Select, ColumnElement
+from sqlalchemy.dialects.postgresql import array, insert, JSONB
+from fastapi import status
+import datetime as dt
 
-from app.db.tables import Image, ImageStatus
+from app.db.listener import CALLBACK_CHANNEL, IMAGE_DONE_CHANNEL, IMAGE_QUEUE_CHANNEL
+from app.db.tables import EarlyOutput, ImageCallback, Image, ImageStatus
+from app.schemas.ai import AIOutputSchema
+from app.schemas.image import MAX_IMAGE_PRIORITY, MAX_BATCH_SIZE
+from app.services.task_cache import task_cache
 from .base import BaseRepository
+from .image_cache import ImageCacheRepository
+
+QUEUE_LOCK_KEY = 87151
+# Images holding a fal slot. A submit whose lease ran out belongs to a dead worker,
+# its images wait to be claimed again and must not keep the slot.
+IS_GENERATING = or_(
+    Image.status == ImageStatus.queued,
+    and_(Image.status == ImageStatus.submitting, Image.lease_expires_at > func.now())
+)
 
 
 class ImageRepository(BaseRepository):
@@ -12,27 +28,576 @@ class ImageRepository(BaseRepository):
 
     async def create(self, **fields) -> Image:
         model = Image(**fields)
-        return await self._create(model)
+        await self.notify_queue()
+        await self._create(model, do_commit=False)
+        if isinstance(fields.get("expires_at"), ColumnElement):
+            # Computed by the database clock, read back before the commit
+            await self.session.refresh(model, ["expires_at"])
+        if model.status == ImageStatus.finished:
+            # Finished on creation (a result cache hit), its callback is queued with the insert
+            await self.enqueue_callbacks([model])
+        await self.commit()
+        return model
 
-    async def update(self, image_id: str, **data) -> Image:
+    async def create_many(self, rows: list[dict], **shared) -> list[Image]:
+        """Insert all rows with a single multi-row INSERT, `shared` values may be SQL expressions"""
+        models = list(await self.session.scalars(insert(Image).values(**shared).returning(Image), rows))
+        await self.notify_queue()
+        await self.commit()
+        self.response.status_code = status.HTTP_201_CREATED
+        return models
+
+    async def _translate_status(self, data: dict) -> dict:
         if "is_finished" in data:
             value = data.pop("is_finished")
             data['status'] = ImageStatus.finished if value else ImageStatus.queued
         if "is_invalid" in data and data.pop("is_invalid"):
             data['status'] = ImageStatus.error
+        if 'status' in data:
+            data['lease_expires_at'] = None
+        if data.get('status') in (ImageStatus.finished, ImageStatus.error):
+            await self.notify_queue()
+        return data
 
+    async def update(self, image_id: str, **data) -> Image:
+        data = await self._translate_status(data)
         return await self._update(image_id, write_none=True, **data)
 
+    async def update_many(
+            self,
+            image_ids: list[UUID] | Select,
+            with_followers: bool = False,
+            do_commit: bool = True,
+            **data
+    ):
+        """Update the images with one statement, values may be SQL expressions.
+
+        With `with_followers` the images coalesced into them are updated too.
+        The images are locked first, so a follower attached concurrently is
+        either committed before the update or sees its leader already updated.
+        """
+        data = await self._translate_status(data)
+        condition = Image.id.in_(image_ids)
+        if with_followers:
+            await self.session.execute(select(Image.id).where(condition).with_for_update())
+            condition = or_(condition, Image.leader_id.in_(image_ids))
+        query = (
+            update(Image)
+            .where(condition)
+            .values(**data)
+            .execution_options(synchronize_session=False)
+        )
+        if data.get('status') in (ImageStatus.finished, ImageStatus.error):
+            query = query.returning(
+                Image.id,
+                Image.callback_url,
+                func.pg_notify(IMAGE_DONE_CHANNEL, cast(Image.id, String))
+            )
+            await self.enqueue_callbacks(list(await self.session.execute(query)))
+        else:
+            await self.session.execute(query)
+        if do_commit:
+            await self.commit()
+
+    async def write_transitions(self, transitions: list[dict]):
+        """Apply status transitions of many images with one UPDATE ... FROM (VALUES ...).
+
+        Every transition holds id, status, request_id, output_index and comment,
+        None keeps the current value. Followers of the images are updated too,
+        after the images are locked like in `update_many`.
+        """
+        ids = [transition['id'] for transition in transitions]
+        rows = values(
+            column('id', Uuid),
+            column('status', String),
+            column('request_id', String),
+            column('output_index', Integer),
+            column('comment', String),
+            name='transitions'
+        ).data([
+            (t['id'], t['status'].name, t.get('request_id'), t.get('output_index'), t.get('comment'))
+            for t in transitions
+        ])
+        await self.session.execute(select(Image.id).where(Image.id.in_(ids)).with_for_update())
+        query = (
+            update(Image)
+            .where(
+                or_(Image.id == rows.c.id, Image.leader_id == rows.c.id),
+                # Images cancelled or expired while being submitted stay done
+                or_(Image.status.is_(None), Image.status.notin_([ImageStatus.finished, ImageStatus.error]))
+            )
+            .values(
+                status=cast(rows.c.status, Image.status.type),
+                # A VALUES column holding only NULLs is typed text, the casts keep it comparable
+                request_id=func.coalesce(cast(rows.c.request_id, String), Image.request_id),
+                output_index=func.coalesce(cast(rows.c.output_index, Integer), Image.output_index),
+                comment=func.coalesce(cast(rows.c.comment, String), Image.comment),
+                lease_expires_at=None
+            )
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(await self.session.execute(
+            query.returning(Image.id, Image.status, Image.request_id, Image.cache_key, Image.callback_url)
+        ))
+        done = [row for row in rows if row.status in (ImageStatus.finished, ImageStatus.error)]
+        if done:
+            await self.notify_queue()
+            await self.notify_done([row.id for row in done])
+            await self.enqueue_callbacks(done)
+        queued = [row for row in rows if row.status == ImageStatus.queued]
+        if queued:
+            await self._apply_early_outputs(queued)
+        await self.commit()
+
+    async def finish_request(self, request_id: str, output: AIOutputSchema, do_commit: bool = True) -> list:
+        """Finish the queued images of the fal request with one UPDATE, the n-th image gets the n-th output.
+
+        Images already finished are left alone, so a repeated delivery returns no rows.
+        """
+        images = output.payload.images
+        index = Image.output_index + 1
+        query = (
+            update(Image)
+            .where(Image.request_id == request_id, Image.status == ImageStatus.queued)
+            .values(
+                status=ImageStatus.finished,
+                lease_expires_at=None,
+                image_url=func.coalesce(array([image.url for image in images])[index], images[0].url),
+                width=func.coalesce(array([image.width for image in images])[index], images[0].width),
+                height=func.coalesce(array([image.height for image in images])[index], images[0].height),
+                seed=output.payload.seed
+            )
+            # Identical notifications of a transaction are delivered once
+            .returning(
+                Image.id,
+                Image.cache_key,
+                Image.callback_url,
+                func.pg_notify(IMAGE_QUEUE_CHANNEL, ''),
+                func.pg_notify(IMAGE_DONE_CHANNEL, cast(Image.id, String))
+            )
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(await self.session.execute(query))
+        await self.enqueue_callbacks(rows)
+        if do_commit:
+            await self.commit()
+        return rows
+
+    async def fail_request(self, request_id: str, comment: str, do_commit: bool = True):
+        await self.update_many(
+            select(Image.id).where(Image.request_id == request_id, Image.status == ImageStatus.queued),
+            with_followers=True,
+            do_commit=do_commit,
+            is_finished=False,
+            is_invalid=True,
+            comment=comment
+        )
+
+    async def hold_early_output(self, image_id: UUID, output: AIOutputSchema) -> bool:
+        """Keep the output of a fal request whose image is still being submitted, return whether it was kept.
+
+        The image is locked like in `write_transitions`, so its submit result is
+        either stored already or stored afterwards and finds the output.
+        """
+        submitting = await self.session.scalar(
+            select(Image.id)
+            .where(Image.id == image_id, Image.status == ImageStatus.submitting)
+            .with_for_update()
+        )
+        if submitting is None:
+            return False
+        await self.session.execute(
+            insert(EarlyOutput)
+            .values(id=uuid4(), request_id=output.request_id, output=output.model_dump(mode='json'))
+            .on_conflict_do_nothing(index_elements=[EarlyOutput.request_id])
+        )
+        await self.commit()
+        return True
+
+    async def _apply_early_outputs(self, queued: list):
+        """Finish or fail the just queued images whose webhook arrived during their submit"""
+        outputs = await self.session.scalars(
+            delete(EarlyOutput)
+            .where(EarlyOutput.request_id.in_({row.request_id for row in queued}))
+            .returning(EarlyOutput.output)
+        )
+        for output in [AIOutputSchema.model_validate(output) for output in outputs]:
+            if output.payload is None:
+                await self.fail_request(output.request_id, output.error, do_commit=False)
+                continue
+            await self.finish_request(output.request_id, output, do_commit=False)
+            if any(row.cache_key is not None for row in queued if row.request_id == output.request_id):
+                image_cache_repository = await ImageCacheRepository().child(session=self.session)
+                await image_cache_repository.store_request(output.request_id)
+
+    async def drop_early_outputs(self, age: dt.timedelta):
+        """Drop held outputs whose images never got their submit result, e.g. after a lease expired"""
+        await self.session.execute(delete(EarlyOutput).where(EarlyOutput.created_at < func.now() - age))
+        await self.commit()
+
+    async def expire_unsended(self) -> int:
+        """Fail the unsended images whose deadline passed with one UPDATE, the caller commits.
+
+        Followers of an expired image that are still wanted get a new leader.
+        """
+        query = (
+            update(Image)
+            .where(Image.status.is_(None), Image.expires_at < func.now())
+            .values(status=ImageStatus.error, comment="Expired", lease_expires_at=None)
+            .returning(
+                Image.id,
+                Image.leader_id,
+                Image.callback_url,
+                func.pg_notify(IMAGE_DONE_CHANNEL, cast(Image.id, String))
+            )
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(await self.session.execute(query))
+        if rows:
+            await self.promote_followers([row.id for row in rows if row.leader_id is None])
+            await self.enqueue_callbacks(rows)
+        return len(rows)
+
+    async def cancel(self, image_id: UUID) -> Image:
+        """Fail the image with comment Cancelled and give its followers a new leader.
+
+        A leader cancelled while being submitted keeps its followers and its lease:
+        its submit result moves them to the fal request, and when the lease expires
+        without a result `promote_orphans` gives them a new leader.
+
+        Return the image as it was before, with `follower_count`, the number of other
+        images still waiting for its fal request. Raises 409 when it is already done.
+        """
+        image = await self.session.scalar(select(Image).where(Image.id == image_id).with_for_update())
+        if image is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND)
+        if image.status in (ImageStatus.finished, ImageStatus.error):
+            raise HTTPException(status.HTTP_409_CONFLICT, "Task is already done")
+        # Detached, so it keeps the state before the cancel while later reads load the new one
+        self.session.expunge(image)
+        submitting = image.status == ImageStatus.submitting
+        rows = list(await self.session.execute(
+            update(Image)
+            .where(Image.id == image.id)
+            .values(
+                status=ImageStatus.error,
+                comment="Cancelled",
+                lease_expires_at=image.lease_expires_at if submitting else None
+            )
+            .returning(Image.id, Image.callback_url, func.pg_notify(IMAGE_DONE_CHANNEL, cast(Image.id, String)))
+            .execution_options(synchronize_session=False)
+        ))
+        if image.leader_id is None and not submitting:
+            await self.promote_followers([image.id])
+        await self.enqueue_callbacks(rows)
+        await self.notify_queue()
+        image.follower_count = 0
+        if image.request_id is not None:
+            image.follower_count = await self.session.scalar(
+                select(func.count())
+                .where(Image.request_id == image.request_id, Image.status == ImageStatus.queued)
+            )
+        await self.commit()
+        await task_cache.invalidate(str(image.id))
+        return image
+
+    async def promote_followers(self, leader_ids: list[UUID]):
+        """Make the oldest pending follower of every image the leader of the others"""
+        heirs = (
+            select(Image.leader_id.label('old'), Image.id.label('new'))
+            .where(
+                Image.leader_id.in_(leader_ids),
+                or_(Image.status.is_(None), Image.status.notin_([ImageStatus.finished, ImageStatus.error]))
+            )
+            .distinct(Image.leader_id)
+            .order_by(Image.leader_id, Image.created_at)
+            .subquery()
+        )
+        await self.session.execute(
+            update(Image)
+            .where(Image.leader_id == heirs.c.old)
+            .values(leader_id=case((Image.id == heirs.c.new, None), else_=heirs.c.new))
+            .execution_options(synchronize_session=False)
+        )
+
+    async def promote_orphans(self):
+        """Give a new leader to the followers of leaders cancelled during a submit whose result never came"""
+        leaders = select(Image.leader_id).where(Image.status.is_(None), Image.leader_id.is_not(None))
+        query = select(Image.id).where(
+            Image.id.in_(leaders),
+            Image.status == ImageStatus.error,
+            Image.lease_expires_at < func.now()
+        )
+        leader_ids = list(await self.session.scalars(query))
+        if leader_ids:
+            await self.promote_followers(leader_ids)
+
+    async def claim_stale_requests(self, stale: dt.timedelta, deadline: dt.timedelta, count: int) -> list:
+        """Return fal requests queued without a result for longer than `stale`.
+
+        The returned rows are touched, so concurrent reconcilers skip them
+        until they are stale again. Each row carries whether its deadline passed.
+        """
+        stale_images = (
+            select(Image.id)
+            .where(
+                Image.status == ImageStatus.queued,
+                Image.leader_id.is_(None),
+                func.coalesce(Image.updated_at, Image.created_at) < func.now() - stale
+            )
+            .order_by(func.coalesce(Image.updated_at, Image.created_at))
+            .limit(count)
+            .with_for_update(skip_locked=True)
+        )
+        query = (
+            update(Image)
+            .where(Image.id.in_(stale_images))
+            .values(updated_at=func.now())
+            .returning(
+                Image.id,
+                Image.request_id,
+                Image.model,
+                (Image.created_at < func.now() - deadline).label('expired')
+            )
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(await self.session.execute(query))
+        await self.commit()
+        return rows
+
     async def get(self, image_id: str) -> Image:
         return await self._get_one(id=image_id)
 
+    async def find_leader(self, cache_key: str) -> Image | None:
+        """Return the in-flight image with the cache key, locked until the transaction ends"""
+        query = (
+            select(Image)
+            .where(
+                Image.cache_key == cache_key,
+                Image.leader_id.is_(None),
+                or_(
+                    Image.status.is_(None),
+                    Image.status == ImageStatus.submitting,
+                    Image.status == ImageStatus.queued
+                )
+            )
+            .order_by(Image.created_at)
+            .limit(1)
+            .with_for_update()
+        )
+        return await self.session.scalar(query)
+
+    async def list_by_ids(self, image_ids: list[UUID]) -> list[Image]:
+        return list(await self.session.scalars(select(Image).where(Image.id.in_(image_ids))))
+
+    async def list_batch(self, batch_id: UUID) -> list[Image]:
+        return list(await self._get_many(count=MAX_BATCH_SIZE, batch_id=batch_id))
+
     async def list_in_progress(self) -> list[Image]:
         return list(await self._get_many(count=1000000, status=ImageStatus.queued))
 
-    async def count_generating_images(self) -> int:
-        models = list(await self._get_many(status=ImageStatus.queued))
-        return len(models)
+    async def count_generating_images(self) -> dict[str, int]:
+        """Return the number of fal requests per model that are queued or being submitted under a live lease"""
+        query = (
+            select(Image.model, func.count(func.distinct(func.coalesce(Image.request_id, cast(Image.id, String)))))
+            .where(IS_GENERATING)
+            .group_by(Image.model)
+        )
+        rows = await self.session.execute(query)
+        return {model: count for model, count in rows}
+
+    async def queue_stats(self, window: dt.timedelta) -> tuple[int, int]:
+        """Return the number of images waiting to be submitted and of images submitted within the window"""
+        depth = select(func.count()).where(Image.status.is_(None), Image.leader_id.is_(None)).scalar_subquery()
+        started = select(func.count()).where(Image.submitted_at > func.now() - window).scalar_subquery()
+        row = (await self.session.execute(select(depth, started))).one()
+        return row[0], row[1]
+
+    async def lock_queue(self):
+        """Serialize dispatch cycles of all workers until the transaction ends"""
+        await self.session.execute(select(func.pg_advisory_xact_lock(QUEUE_LOCK_KEY)))
+
+    async def claim_unsended(
+            self,
+            model: str,
+            count: int,
+            lease: dt.timedelta,
+            priority_aging: dt.timedelta,
+            bundle_weights: dict[str, float] | None = None
+    ) -> list[Image]:
+        """Mark up to `count` unsended images of the model as submitting and return them.
+
+        Higher priority lanes go first. Every `priority_aging` of waiting
+        raises an image one lane, so low priority work is never starved.
+        Inside a lane images are picked by weighted fair share: app bundles take turns in
+        proportion to their weight, and users take turns within a bundle.
+        Images a bundle or user already has in flight count as turns taken.
+
+        Rows locked by a concurrent claim are skipped. Rows whose lease has
+        expired (the worker died before storing the submit result) are
+        claimed again. The caller commits the claim.
+        """
+        is_claimable = and_(
+            or_(
+                Image.status.is_(None),
+                and_(Image.status == ImageStatus.submitting, Image.lease_expires_at < func.now())
+            ),
+            Image.model == model,
+            Image.leader_id.is_(None)
+        )
+        running_users = (
+            select(Image.app_bundle, Image.user_id, func.count().label('running'))
+            .where(IS_GENERATING)
+            .group_by(Image.app_bundle, Image.user_id)
+            .subquery()
+        )
+        running_bundles = (
+            select(Image.app_bundle, func.count().label('running'))
+            .where(IS_GENERATING)
+            .group_by(Image.app_bundle)
+            .subquery()
+        )
+
+        waited = func.extract('epoch', func.now() - Image.created_at)
+        lane = func.least(
+            MAX_IMAGE_PRIORITY,
+            Image.priority + func.floor(waited / priority_aging.total_seconds())
+        )
+        user_position = func.row_number().over(
+            partition_by=(Image.app_bundle, Image.user_id),
+            order_by=(lane.desc(), Image.created_at)
+        )
+        candidates = (
+            select(
+                Image.id,
+                Image.app_bundle,
+                Image.created_at,
+                lane.label('lane'),
+                user_position.label('position'),
+                func.coalesce(running_users.c.running, 0).label('running')
+            )
+            .outerjoin(running_users, and_(
+                running_users.c.app_bundle == Image.app_bundle,
+                running_users.c.user_id == Image.user_id
+            ))
+            .where(is_claimable)
+            .subquery()
+        )
+        # No user can get more than `count` images in one claim
+        candidates = select(candidates).where(candidates.c.position <= count).subquery()
+
+        bundle_position = func.row_number().over(
+            partition_by=candidates.c.app_bundle,
+            order_by=(candidates.c.lane.desc(), candidates.c.position + candidates.c.running, candidates.c.created_at)
+        ) + func.coalesce(running_bundles.c.running, 0)
+        weight = literal(1.0)
+        if bundle_weights:
+            weight = case(bundle_weights, value=candidates.c.app_bundle, else_=1.0)
+        ranked = (
+            select(
+                candidates.c.id,
+                candidates.c.created_at,
+                candidates.c.lane,
+                (bundle_position / cast(weight, Float)).label('virtual_time')
+            )
+            .outerjoin(running_bundles, running_bundles.c.app_bundle == candidates.c.app_bundle)
+            .subquery()
+        )
+        picked = (
+            select(ranked.c.id)
+            .order_by(ranked.c.lane.desc(), ranked.c.virtual_time, ranked.c.created_at)
+            .limit(count)
+        )
+
+        return await self._claim(select(Image.id).where(Image.id.in_(picked), is_claimable), lease)
+
+    async def claim_batch_siblings(self, image: Image, count: int, lease: dt.timedelta) -> list[Image]:
+        """Claim up to `count` unsended images of the batch with the same prompt and size"""
+        query = (
+            select(Image.id)
+            .where(
+                Image.status.is_(None),
+                Image.batch_id == image.batch_id,
+                Image.prompt == image.prompt,
+                Image.image_size == image.image_size,
+                Image.model == image.model
+            )
+            .order_by(Image.created_at)
+            .limit(count)
+        )
+        return await self._claim(query, lease)
+
+    async def _claim(self, query: Select, lease: dt.timedelta) -> list[Image]:
+        query = (
+            update(Image)
+            .where(Image.id.in_(query.with_for_update(skip_locked=True)))
+            .values(status=ImageStatus.submitting, lease_expires_at=func.now() + lease, submitted_at=func.now())
+            .returning(Image)
+            .execution_options(synchronize_session=False)
+        )
+        return list(await self.session.scalars(query))
+
+    async def claim_unmirrored(self, count: int, lease: dt.timedelta, max_attempts: int) -> list:
+        """Return finished images not yet copied to our storage, leased to this worker"""
+        unmirrored = (
+            select(Image.id)
+            .where(
+                Image.status == ImageStatus.finished,
+                Image.file_key.is_(None),
+                Image.image_url.is_not(None),
+                Image.mirror_attempts < max_attempts,
+                or_(Image.mirror_lease_expires_at.is_(None), Image.mirror_lease_expires_at < func.now())
+            )
+            .order_by(Image.created_at)
+            .limit(count)
+            .with_for_update(skip_locked=True)
+        )
+        query = (
+            update(Image)
+            .where(Image.id.in_(unmirrored))
+            .values(mirror_attempts=Image.mirror_attempts + 1, mirror_lease_expires_at=func.now() + lease)
+            .returning(Image.id, Image.image_url)
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(await self.session.execute(query))
+        await self.commit()
+        return rows
+
+    async def set_files(self, files: list[tuple[UUID, str, str, dict]]):
+        """Store the storage key, content type and variants of mirrored images"""
+        rows = values(
+            column('id', Uuid), column('file_key', String), column('file_content_type', String),
+            column('variants', JSONB),
+            name='files'
+        ).data(files)
+        await self.session.execute(
+            update(Image)
+            .where(Image.id == rows.c.id)
+            .values(
+                file_key=rows.c.file_key,
+                file_content_type=rows.c.file_content_type,
+                variants=rows.c.variants,
+                mirror_lease_expires_at=None
+            )
+            .execution_options(synchronize_session=False)
+        )
+        # The tasks changed, cached copies are dropped in every worker
+        await self.notify_done([file[0] for file in files])
+        await self.commit()
+
+    async def notify_queue(self):
+        """Wake queue dispatchers in every process once the transaction commits"""
+        await self.session.execute(select(func.pg_notify(IMAGE_QUEUE_CHANNEL, '')))
 
-    async def list_unsended(self) -> list[Image]:
-        return list(await self._get_many(count=1000000, status=None, exclude_none=False))
+    async def enqueue_callbacks(self, rows: list):
+        """Queue callback deliveries of the done images in the same transaction"""
+        deliveries = [dict(id=uuid4(), image_id=row.id, url=row.callback_url) for row in rows if row.callback_url]
+        if deliveries:
+            await self.session.execute(
+                insert(ImageCallback).values(deliveries).returning(func.pg_notify(CALLBACK_CHANNEL, ''))
+            )
 
+    async def notify_done(self, image_ids: list[UUID]):
+        """Wake clients waiting for the images in every process once the transaction commits"""
+        ids = func.unnest(array([str(image_id) for image_id in image_ids])).table_valued('id').render_derived()
+        await self.session.execute(select(func.pg_notify(IMAGE_DONE_CHANNEL, ids.c.id)))
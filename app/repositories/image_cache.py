@@ -0,0 +1,55 @@
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert
+import datetime as dt
+
+from app.db.tables import Image, ImageCache, ImageStatus
+from .base import BaseRepository
+
+
+class ImageCacheRepository(BaseRepository):
+    base_table = ImageCache
+
+    async def hit(self, key: str, ttl: dt.timedelta) -> str | None:
+        """Return the cached image url younger than ttl and mark the entry as recently used"""
+        query = (
+            update(ImageCache)
+            .where(ImageCache.key == key, ImageCache.created_at > func.now() - ttl)
+            .values(hits=ImageCache.hits + 1, last_hit_at=func.now())
+            .returning(ImageCache.image_url)
+        )
+        return await self.session.scalar(query)
+
+    async def store_request(self, request_id: str):
+        """Cache the outputs of the finished deterministic images of the fal request"""
+        outputs = (
+            select(func.gen_random_uuid(), Image.cache_key, Image.image_url)
+            .where(
+                Image.request_id == request_id,
+                Image.cache_key.is_not(None),
+                Image.status == ImageStatus.finished
+            )
+            .distinct(Image.cache_key)
+        )
+        query = insert(ImageCache).from_select(['id', 'key', 'image_url'], outputs)
+        query = query.on_conflict_do_update(
+            index_elements=[ImageCache.key],
+            set_={
+                'image_url': query.excluded.image_url,
+                'created_at': func.now(),
+                'last_hit_at': func.now()
+            }
+        )
+        await self.session.execute(query)
+        await self.commit()
+
+    async def evict(self, ttl: dt.timedelta, max_entries: int) -> int:
+        """Drop expired entries, then the least recently used ones above max_entries"""
+        expired = await self.session.execute(
+            delete(ImageCache).where(ImageCache.created_at < func.now() - ttl)
+        )
+        overflow = select(ImageCache.id).order_by(ImageCache.last_hit_at.desc()).offset(max_entries)
+        evicted = await self.session.execute(
+            delete(ImageCache).where(ImageCache.id.in_(overflow))
+        )
+        await self.commit()
+        return expired.rowcount + evicted.rowcount
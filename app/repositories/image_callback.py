@@ -0,0 +1,41 @@
+from uuid import UUID
+from sqlalchemy import select, update, delete, func
+import datetime as dt
+
+from app.db.tables import ImageCallback
+from .base import BaseRepository
+
+
+class ImageCallbackRepository(BaseRepository):
+    base_table = ImageCallback
+
+    async def claim_due(self, count: int, lease: dt.timedelta) -> list[ImageCallback]:
+        """Take up to `count` due deliveries, they are due again after the lease if the worker dies"""
+        due = (
+            select(ImageCallback.id)
+            .where(ImageCallback.next_attempt_at <= func.now())
+            .order_by(ImageCallback.next_attempt_at)
+            .limit(count)
+            .with_for_update(skip_locked=True)
+        )
+        query = (
+            update(ImageCallback)
+            .where(ImageCallback.id.in_(due))
+            .values(attempts=ImageCallback.attempts + 1, next_attempt_at=func.now() + lease)
+            .returning(ImageCallback)
+            .execution_options(synchronize_session=False)
+        )
+        deliveries = list(await self.session.scalars(query))
+        await self.commit()
+        return deliveries
+
+    async def delete_many(self, delivery_ids: list[UUID]):
+        await self.session.execute(delete(ImageCallback).where(ImageCallback.id.in_(delivery_ids)))
+
+    async def retry_later(self, delivery_id: UUID, delay: dt.timedelta | None, error: str):
+        """Schedule the next attempt after delay, None gives the delivery up"""
+        await self.session.execute(
+            update(ImageCallback)
+            .where(ImageCallback.id == delivery_id)
+            .values(next_attempt_at=func.now() + delay if delay is not None else None, last_error=error)
+        )
@@ -0,0 +1,12 @@
+from sqlalchemy import select
+
+from app.db.tables import ModelLimit
+from .base import BaseRepository
+
+
+class ModelLimitRepository(BaseRepository):
+    base_table = ModelLimit
+
+    async def get_limits(self) -> dict[str, int]:
+        rows = await self.session.execute(select(ModelLimit.model, ModelLimit.limit))
+        return {model: limit for model, limit in rows}
@@ -0,0 +1,51 @@
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert
+import datetime as dt
+
+from app.db.tables import SourceUpload
+from .base import BaseRepository
+
+
+class SourceUploadRepository(BaseRepository):
+    base_table = SourceUpload
+
+    async def hit(self, digest: str, ttl: dt.timedelta) -> str | None:
+        """Return the fal url of an upload with the digest younger than ttl.
+
+        Committed at once, a miss is followed by a slow upload and must not hold
+        the connection of the session meanwhile.
+        """
+        query = (
+            update(SourceUpload)
+            .where(SourceUpload.digest == digest, SourceUpload.created_at > func.now() - ttl)
+            .values(hits=SourceUpload.hits + 1, last_hit_at=func.now())
+            .returning(SourceUpload.image_url)
+        )
+        image_url = await self.session.scalar(query)
+        await self.commit()
+        return image_url
+
+    async def store(self, digest: str, image_url: str):
+        query = insert(SourceUpload).values(digest=digest, image_url=image_url, id=func.gen_random_uuid())
+        query = query.on_conflict_do_update(
+            index_elements=[SourceUpload.digest],
+            set_={
+                'image_url': query.excluded.image_url,
+                'created_at': func.now(),
+                'last_hit_at': func.now()
+            }
+        )
+        await self.session.execute(query)
+        await self.commit()
+
+    async def evict(self, ttl: dt.timedelta, max_entries: int) -> int:
+        """Drop expired entries, then the least recently used ones above max_entries"""
+        expired = await self.session.execute(
+            delete(SourceUpload).where(SourceUpload.created_at < func.now() - ttl)
+        )
+        overflow = select(SourceUpload.id).order_by(SourceUpload.last_hit_at.desc()).offset(max_entries)
+        evicted = await self.session.execute(
+            delete(SourceUpload).where(SourceUpload.id.in_(overflow))
+        )
+        await self.commit()
+        return expired.rowcount + evicted.rowcount
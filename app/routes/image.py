@@ -1,12 +1,16 @@
-import io
-from fastapi import APIRouter, Depends, File, Request, Header, HTTPException, Response, UploadFile
+from fastapi import APIRouter, Depends, File, Request, Header, HTTPException, Query, Response, UploadFile
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi import BackgroundTasks
 from uuid import UUID
 import os
 
-from app.schemas.image import ImageTaskSchema, ImageTaskCreateSchema
+from app.schemas.image import ImageTaskSchema, ImageTaskCreateSchema, ImageBatchSchema, ImageBatchCreateSchema, MAX_BATCH_SIZE
 from app.schemas.ai import AIOutputSchema
 from app.services.image import ImageService
+from app.services.notifier import completion_settings
+from app.services.rate_limit import rate_limiter
+from app.services.storage import IMMUTABLE_CACHE_CONTROL, LocalStorage, storage
+from app.services.task_cache import task_cache_settings
 
 router = APIRouter(prefix="/image", tags=["Image"])
 valid_access_token = os.getenv("ACCESS_TOKEN", "123")
@@ -20,6 +24,11 @@ valid_access_token = os.getenv("ACCESS_TOKEN", "123")
         For do request you need to specify Access-Token header, ask me in telegram about it.
 
         Image sizes: square_hd square portrait_4_3 portrait_16_9 landscape_4_3 landscape_16_9
+        Priority: from 0 (bulk, default) to 9 (user is waiting). Waiting tasks are raised one level every minute.
+        Deterministic: identical requests get the same image, repeats are answered from the cache without generation.
+        Callback URL: the task is POSTed there once it is finished or failed, it must resolve to a public address.
+        Deadline / TTL seconds: tasks not sent for generation by then fail with comment "Expired".
+        Requests are rate limited per access token, app bundle and user, 429 with Retry-After past the limits.
     """
 )
 async def create_image_task(
@@ -29,10 +38,60 @@ async def create_image_task(
 ):
     if access_token != valid_access_token:
         raise HTTPException(401)
+    await rate_limiter.hit(
+        "create_image", access_token=access_token, app_bundle=schema.app_bundle, user_id=schema.user_id
+    )
     image = await service.create(schema)
     return image
 
 
+@router.post(
+    '/batch',
+    response_model=ImageBatchSchema,
+    description="""
+        Endpoint for start a batch of image generation tasks: num_images images for every prompt.
+        For do request you need to specify Access-Token header, ask me in telegram about it.
+
+        Image sizes: square_hd square portrait_4_3 portrait_16_9 landscape_4_3 landscape_16_9
+        Priority: from 0 (bulk, default) to 9 (user is waiting). Waiting tasks are raised one level every minute.
+        Callback URL: the task is POSTed there once it is finished or failed, it must resolve to a public address.
+        Deadline / TTL seconds: tasks not sent for generation by then fail with comment "Expired".
+        Requests are rate limited per access token, app bundle and user, 429 with Retry-After past the limits.
+    """
+)
+async def create_image_batch(
+        schema: ImageBatchCreateSchema,
+        access_token: str = Header(),
+        service: ImageService = Depends()
+):
+    if access_token != valid_access_token:
+        raise HTTPException(401)
+    # Counted in images, so one batch weighs as much as its single requests
+    await rate_limiter.hit(
+        "create_batch", len(schema.prompts) * schema.num_images,
+        access_token=access_token, app_bundle=schema.app_bundle, user_id=schema.user_id
+    )
+    return await service.create_batch(schema)
+
+
+@router.get(
+    '/batch/{batch_id}',
+    response_model=ImageBatchSchema,
+    description="""
+        Endpoint for check the tasks of an image generation batch.
+        For do request you need to specify Access-Token header, ask me in telegram about it.
+    """
+)
+async def get_image_batch(
+        batch_id: UUID,
+        access_token: str = Header(),
+        service: ImageService = Depends()
+):
+    if access_token != valid_access_token:
+        raise HTTPException(401)
+    return await service.get_batch(batch_id)
+
+
 @router.post(
     '/improve',
     response_model=ImageTaskSchema,
@@ -41,6 +100,11 @@ async def create_image_task(
         For do request you need to specify Access-Token header, ask me in telegram about it.
 
         Image sizes: square_hd square portrait_4_3 portrait_16_9 landscape_4_3 landscape_16_9
+        Priority: from 0 (bulk, default) to 9 (user is waiting). Waiting tasks are raised one level every minute.
+        Deterministic: identical requests get the same image, repeats are answered from the cache without generation.
+        Callback URL: the task is POSTed there once it is finished or failed, it must resolve to a public address.
+        Deadline / TTL seconds: tasks not sent for generation by then fail with comment "Expired".
+        Requests are rate limited per access token, app bundle and user, 429 with Retry-After past the limits.
     """
 )
 async def create_image_to_image_task(
@@ -51,26 +115,146 @@ async def create_image_to_image_task(
 ):
     if access_token != valid_access_token:
         raise HTTPException(401)
-    image = await service.create_img2img(schema, io.BytesIO(await file.read()))
+    await rate_limiter.hit(
+        "improve_image", access_token=access_token, app_bundle=schema.app_bundle, user_id=schema.user_id
+    )
+    image = await service.create_img2img(schema, file)
     return image
 
 
+@router.get(
+    '/stream',
+    response_class=StreamingResponse,
+    description="""
+        Endpoint for follow the tasks of image generation as server-sent events.
+        For do request you need to specify Access-Token header, ask me in telegram about it.
+
+        An "image" event with the task is sent as soon as a task is finished or failed,
+        the stream closes once every task is done.
+    """
+)
+async def stream_image_tasks(
+        ids: list[UUID] = Query(max_length=MAX_BATCH_SIZE),
+        access_token: str = Header(),
+        service: ImageService = Depends()
+):
+    if access_token != valid_access_token:
+        raise HTTPException(401)
+    events = await service.stream(ids)
+    return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @router.get(
     '/{image_id}',
     response_model=ImageTaskSchema,
     description="""
         Endpoint for check the task of image generation status.
         For do request you need to specify Access-Token header, ask me in telegram about it.
+
+        Responses carry an ETag, send it back in If-None-Match to get 304 while the task is unchanged.
     """
 )
 async def get_image_task(
+        image_id: UUID,
+        if_none_match: str | None = Header(None),
+        access_token: str = Header(),
+        service: ImageService = Depends()
+):
+    if access_token != valid_access_token:
+        raise HTTPException(401)
+    cached = await service.get_cached(image_id)
+    headers = {
+        "ETag": cached.etag,
+        # Private, the task is only for holders of the access token
+        "Cache-Control": (
+            f"private, max-age={task_cache_settings.task_cache_http_max_age}" if cached.is_done else "no-cache"
+        )
+    }
+    if if_none_match == cached.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+@router.get(
+    '/{image_id}/wait',
+    response_model=ImageTaskSchema,
+    description="""
+        Endpoint for wait until the task of image generation is done.
+        For do request you need to specify Access-Token header, ask me in telegram about it.
+
+        Responds as soon as the task is finished or failed, or after timeout seconds with the current state.
+    """
+)
+async def wait_image_task(
+        image_id: UUID,
+        timeout: float = Query(30, ge=0, le=completion_settings.wait_max_timeout),
+        access_token: str = Header(),
+        service: ImageService = Depends()
+):
+    if access_token != valid_access_token:
+        raise HTTPException(401)
+    return await service.wait(image_id, timeout)
+
+
+@router.get(
+    '/{image_id}/file',
+    response_class=FileResponse,
+    description="""
+        Endpoint for download the generated image.
+        Needs no Access-Token, so it can be used in img tags and behind CDNs.
+
+        Supports Range requests, the file never changes and may be cached forever.
+        Images not copied to our storage yet, or served while no storage is configured,
+        are redirected to fal.
+
+        Variant: one of the task variants (thumbnail_256, thumbnail_512, webp, avif),
+        the original image is returned without it.
+    """
+)
+async def get_image_file(
+        image_id: UUID,
+        variant: str | None = Query(None),
+        service: ImageService = Depends()
+):
+    image = await service.get_finished(image_id)
+    if storage is None:
+        # Mirrored before the storage backend was unset, the fal url still serves the original
+        return RedirectResponse(image.image_url)
+    if variant is not None:
+        if variant not in (image.variants or {}):
+            raise HTTPException(404)
+        key, content_type = image.variants[variant]["key"], image.variants[variant]["content_type"]
+    elif image.file_key is None:
+        return RedirectResponse(image.image_url)
+    else:
+        key, content_type = image.file_key, image.file_content_type
+    if isinstance(storage, LocalStorage):
+        return FileResponse(
+            storage.path(key),
+            media_type=content_type,
+            headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+        )
+    return RedirectResponse(storage.url(key))
+
+
+@router.delete(
+    '/{image_id}',
+    response_model=ImageTaskSchema,
+    description="""
+        Endpoint for cancel a task that is not finished yet, it fails with comment "Cancelled".
+        For do request you need to specify Access-Token header, ask me in telegram about it.
+
+        Tasks in generation are cancelled on fal unless identical tasks still wait for the result.
+    """
+)
+async def cancel_image_task(
         image_id: UUID,
         access_token: str = Header(),
         service: ImageService = Depends()
 ):
     if access_token != valid_access_token:
         raise HTTPException(401)
-    return await service.get(image_id)
+    return await service.cancel(image_id)
 
 
 @router.post("/{image_id}/webhook", include_in_schema=False)
@@ -79,7 +263,6 @@ async def store_ai_output(
         schema: AIOutputSchema,
         service: ImageService = Depends()
 ):
-    print(schema)
     await service.store_ai_output(schema, image_id)
     return "OK"
 
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, model_validator
 from uuid import UUID
 from enum import Enum
 
@@ -14,14 +14,35 @@ class AIOutputSchema(BaseModel):
         images: list[AIImageSchema]
         seed: int
 
-    payload: OutputPayload
+    payload: OutputPayload | None = None
     status: str
     request_id: str
+    error: str | None = None
+
+    @model_validator(mode='before')
+    @classmethod
+    def drop_error_payload(cls, data):
+        # The payload of a failed request holds error details instead of images
+        if isinstance(data, dict) and data.get('status') != 'OK':
+            data = {**data, 'payload': None, 'error': data.get('error') or str(data.get('payload'))}
+        return data
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class AIModel(Enum):
+    flux_schnell = "fal-ai/flux/schnell"
+    sd3_image_to_image = "fal-ai/stable-diffusion-v3-medium/image-to-image"
+
+
+MAX_NUM_IMAGES = {
+    AIModel.flux_schnell: 4,
+    AIModel.sd3_image_to_image: 1,
+}
+
+
 class AIInputSchema(BaseModel):
     prompt: str
     image_size: str
     seed: int
+    num_images: int = 1
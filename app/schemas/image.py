@@ -1,15 +1,30 @@
-from pydantic import BaseModel, HttpUrl, root_validator, ConfigDict, model_validator
+from pydantic import BaseModel, HttpUrl, root_validator, ConfigDict, model_validator, Field
 from enum import Enum
 from uuid import UUID
 import datetime as dt
 
 
+class ImageVariantSchema(BaseModel):
+    url: str | None = None
+    width: int
+    height: int
+    content_type: str
+    size: int
+
+
 class ImageTaskSchema(BaseModel):
     id: UUID
     is_finished: bool
     is_invalid: bool = False
     image_url: HttpUrl | None = None
+    file_url: str | None = None  # our copy of the image, served from storage once mirrored
     comment: str | None = None
+    width: int | None = None
+    height: int | None = None
+    seed: int | None = None
+    variants: dict[str, ImageVariantSchema] | None = None
+    eta_seconds: float | None = None  # estimated wait until generation starts, for tasks still in the queue
+    expires_at: dt.datetime | None = None
 
     @model_validator(mode='before')
     @classmethod
@@ -24,6 +39,14 @@ class ImageTaskSchema(BaseModel):
             state["is_invalid"] = False
         return state
 
+    @model_validator(mode='after')
+    def file_urls(self):
+        if self.is_finished:
+            self.file_url = f"/image/{self.id}/file"
+        for name, variant in (self.variants or {}).items():
+            variant.url = f"/image/{self.id}/file?variant={name}"
+        return self
+
     model_config = ConfigDict(from_attributes=True)
 
 
@@ -36,11 +59,61 @@ class ImageSize(Enum):
     landscape_16_9 = "landscape_16_9"
 
 
+# Pixel dimensions (width, height) fal generates for every preset
+IMAGE_SIZE_DIMENSIONS = {
+    ImageSize.square_hd: (1024, 1024),
+    ImageSize.square: (512, 512),
+    ImageSize.portrait_4_3: (768, 1024),
+    ImageSize.portrait_16_9: (576, 1024),
+    ImageSize.landscape_4_3: (1024, 768),
+    ImageSize.landscape_16_9: (1024, 576),
+}
+
+
+MAX_IMAGE_PRIORITY = 9
+
+
 class ImageTaskCreateSchema(BaseModel):
     prompt: str
     image_size: ImageSize
     user_id: str
     app_bundle: str
+    priority: int = Field(default=0, ge=0, le=MAX_IMAGE_PRIORITY)
+    deterministic: bool = False
+    callback_url: HttpUrl | None = None
+    deadline: dt.datetime | None = None
+    ttl_seconds: int | None = Field(default=None, gt=0)
 
     model_config = ConfigDict(from_attributes=True)
 
+
+
+MAX_BATCH_SIZE = 100
+
+
+class ImageBatchCreateSchema(BaseModel):
+    prompts: list[str] = Field(default_factory=list)
+    prompt: str | None = None
+    num_images: int = Field(default=1, ge=1, le=MAX_BATCH_SIZE)
+    image_size: ImageSize
+    user_id: str
+    app_bundle: str
+    priority: int = Field(default=0, ge=0, le=MAX_IMAGE_PRIORITY)
+    callback_url: HttpUrl | None = None
+    deadline: dt.datetime | None = None
+    ttl_seconds: int | None = Field(default=None, gt=0)
+
+    @model_validator(mode='after')
+    def check_batch_size(self):
+        if self.prompt is not None:
+            self.prompts = self.prompts + [self.prompt]
+        if not self.prompts:
+            raise ValueError("Specify prompt or prompts")
+        if len(self.prompts) * self.num_images > MAX_BATCH_SIZE:
+            raise ValueError(f"Batch can not contain more than {MAX_BATCH_SIZE} images")
+        return self
+
+
+class ImageBatchSchema(BaseModel):
+    id: UUID
+    tasks: list[ImageTaskSchema]
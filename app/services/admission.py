@@ -0,0 +1,98 @@
+from fastapi import HTTPException
+from pydantic_settings import BaseSettings
+import asyncio
+import datetime as dt
+import math
+import time
+
+from app.repositories.image import ImageRepository
+
+
+class AdmissionSettings(BaseSettings):
+    admission_enabled: bool = True
+    admission_max_queue_depth: int = 5000
+    # Shorter queues are always admitted, throughput says little while fal is mostly idle
+    admission_min_queue_depth: int = 100
+    admission_max_wait_seconds: float = 30 * 60
+    admission_status_code: int = 503  # 503 or 429
+    admission_retry_after_seconds: int = 60  # when no throughput is known
+    admission_throughput_window_seconds: int = 5 * 60
+    admission_refresh_seconds: float = 2
+
+
+admission_settings = AdmissionSettings()
+
+
+class AdmissionController:
+    """Rejects new tasks while the backlog is too deep or too slow to drain.
+
+    The queue depth and the number of images submitted to fal within the
+    throughput window are read at most every admission_refresh_seconds
+    per worker. Their ratio gives the estimated time until a new task starts.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.throughput = 0.0  # images started per second
+        self._refreshed_at = -math.inf
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        if time.monotonic() - self._refreshed_at < admission_settings.admission_refresh_seconds:
+            return
+        async with self._lock:
+            if time.monotonic() - self._refreshed_at < admission_settings.admission_refresh_seconds:
+                return
+            window = admission_settings.admission_throughput_window_seconds
+            async with ImageRepository() as image_repository:
+                self.depth, started = await image_repository.queue_stats(dt.timedelta(seconds=window))
+            self.throughput = started / window
+            self._refreshed_at = time.monotonic()
+
+    def eta(self, depth: int | None = None) -> float | None:
+        """Seconds until `depth` queued images (the whole queue by default) are started, None when unknown"""
+        depth = self.depth if depth is None else depth
+        if depth == 0:
+            return 0.0
+        if self.throughput == 0:
+            return None
+        return round(depth / self.throughput, 1)
+
+    def _retry_after(self, depth: int) -> int:
+        if self.throughput == 0:
+            return admission_settings.admission_retry_after_seconds
+        allowed = min(
+            admission_settings.admission_max_queue_depth,
+            admission_settings.admission_max_wait_seconds * self.throughput
+        )
+        return max(1, math.ceil((depth - allowed) / self.throughput))
+
+    async def admit(self, count: int = 1) -> float | None:
+        """Admit `count` new images, return the estimated seconds until they start.
+
+        Raises 503 (or 429) with Retry-After while the queue is past
+        admission_max_queue_depth, or past admission_min_queue_depth with
+        an ETA over admission_max_wait_seconds. Nothing started within the
+        throughput window (fal down or the queue stalled) counts as an endless ETA.
+        """
+        if not admission_settings.admission_enabled:
+            return None
+        await self.refresh()
+        depth = self.depth + count
+        eta = self.eta(depth)
+        if depth > admission_settings.admission_max_queue_depth or (
+                depth > admission_settings.admission_min_queue_depth
+                and (eta is None or eta > admission_settings.admission_max_wait_seconds)
+        ):
+            raise HTTPException(
+                admission_settings.admission_status_code,
+                "Too many images are waiting, retry later",
+                headers={"Retry-After": str(self._retry_after(depth))}
+            )
+        eta = self.eta()
+        # Counted until the next refresh, so a burst can not overshoot the limits
+        self.depth = depth
+        return eta
+
+
+admission = AdmissionController()
@@ -0,0 +1,165 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp.resolver import ThreadedResolver
+from fastapi import HTTPException, status
+from loguru import logger
+from pydantic import HttpUrl
+from pydantic_settings import BaseSettings
+from urllib.parse import urlsplit
+import asyncio
+import datetime as dt
+import ipaddress
+import socket
+
+from app.db.tables import ImageCallback
+from app.repositories.image import ImageRepository
+from app.repositories.image_callback import ImageCallbackRepository
+from app.schemas.image import ImageTaskSchema
+from app.services.dispatcher import QueueDispatcher
+
+
+class CallbackSettings(BaseSettings):
+    callback_sweep_interval: float = 30
+    callback_batch_size: int = 100
+    callback_max_attempts: int = 8
+    callback_backoff_base_seconds: float = 5
+    callback_backoff_max_seconds: float = 60 * 60
+    callback_timeout: float = 10
+    callback_max_connections: int = 100
+    callback_per_host_limit: int = 4
+    # When set, callbacks go only to these hosts and their subdomains
+    callback_allowed_hosts: list[str] = []
+    # Loopback, private and link-local (cloud metadata) addresses are refused unless allowed
+    callback_allow_private_addresses: bool = False
+
+
+callback_settings = CallbackSettings()
+
+
+def is_public_address(address: str) -> bool:
+    return ipaddress.ip_address(address).is_global
+
+
+def is_allowed_host(host: str) -> bool:
+    allowed = callback_settings.callback_allowed_hosts
+    return not allowed or any(host == name or host.endswith("." + name) for name in allowed)
+
+
+async def check_callback_url(url: HttpUrl | None):
+    """Refuse callback urls of hosts outside the allowlist or resolving to non public addresses"""
+    if url is None:
+        return
+    host = url.host.strip("[]")
+    if not is_allowed_host(host):
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "callback_url host is not allowed")
+    if callback_settings.callback_allow_private_addresses:
+        return
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, url.port, type=socket.SOCK_STREAM)
+    except OSError:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "callback_url host can not be resolved")
+    if not all(is_public_address(address[4][0]) for address in addresses):
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "callback_url must point to a public address")
+
+
+class PublicResolver(ThreadedResolver):
+    """Resolves to public addresses only, so a host that changed its records since
+    the url was accepted still can not reach internal services"""
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        hosts = [result for result in await super().resolve(host, port, family) if is_public_address(result["host"])]
+        if not hosts:
+            raise OSError(f"{host} resolves to no public address")
+        return hosts
+
+
+class CallbackDeliverer:
+    """POSTs finished tasks to the callback_url of their clients.
+
+    Deliveries are queued in the image_callbacks table by the transaction
+    that finishes the image, so storing a result never waits for a client.
+    Failed deliveries are retried with exponential backoff.
+    """
+
+    def __init__(self):
+        self._session: ClientSession | None = None
+        self._hosts: dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=callback_settings.callback_max_connections,
+                    limit_per_host=callback_settings.callback_per_host_limit,
+                    resolver=None if callback_settings.callback_allow_private_addresses else PublicResolver()
+                ),
+                timeout=ClientTimeout(total=callback_settings.callback_timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def backoff(attempts: int) -> dt.timedelta | None:
+        if attempts >= callback_settings.callback_max_attempts:
+            return None
+        seconds = callback_settings.callback_backoff_base_seconds * 2 ** (attempts - 1)
+        return dt.timedelta(seconds=min(seconds, callback_settings.callback_backoff_max_seconds))
+
+    async def _post(self, delivery: ImageCallback, task: ImageTaskSchema | None) -> str | None:
+        """Return the error, None when the client accepted the task or the image is gone"""
+        if task is None:
+            return None
+        if not is_allowed_host(urlsplit(delivery.url).hostname or ""):
+            return "Host is not allowed"
+        host = urlsplit(delivery.url).netloc
+        semaphore = self._hosts.setdefault(host, asyncio.Semaphore(callback_settings.callback_per_host_limit))
+        async with semaphore:
+            try:
+                async with self.session.post(
+                    delivery.url,
+                    data=task.model_dump_json(),
+                    headers={"Content-Type": "application/json"},
+                    allow_redirects=False
+                ) as response:
+                    if response.status < 300:
+                        return None
+                    return f"HTTP {response.status}"
+            except Exception as e:
+                return repr(e)
+
+    async def deliver_due(self):
+        """Deliver every due callback, batch by batch"""
+        lease = dt.timedelta(seconds=callback_settings.callback_timeout * 3)
+        while True:
+            async with ImageCallbackRepository() as repository:
+                deliveries = await repository.claim_due(callback_settings.callback_batch_size, lease)
+            if not deliveries:
+                return
+            async with ImageRepository() as image_repository:
+                images = await image_repository.list_by_ids([delivery.image_id for delivery in deliveries])
+                tasks = {image.id: ImageTaskSchema.model_validate(image) for image in images}
+
+            errors = await asyncio.gather(*(
+                self._post(delivery, tasks.get(delivery.image_id)) for delivery in deliveries
+            ))
+
+            async with ImageCallbackRepository() as repository:
+                await repository.delete_many([
+                    delivery.id for delivery, error in zip(deliveries, errors) if error is None
+                ])
+                for delivery, error in zip(deliveries, errors):
+                    if error is None:
+                        continue
+                    delay = self.backoff(delivery.attempts)
+                    if delay is None:
+                        logger.warning(f"Giving up callback of image {delivery.image_id} to {delivery.url}: {error}")
+                    await repository.retry_later(delivery.id, delay, error)
+                await repository.commit()
+
+
+callbacks = CallbackDeliverer()
+callback_dispatcher = QueueDispatcher(callback_settings.callback_sweep_interval)
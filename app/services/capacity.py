@@ -0,0 +1,32 @@
+from pydantic_settings import BaseSettings
+
+from app.schemas.ai import AIModel
+
+
+class CapacitySettings(BaseSettings):
+    fal_flux_schnell_limit: int = 5
+    fal_sd3_image_to_image_limit: int = 5
+
+
+class CapacityScheduler:
+    """Concurrency budget of every fal endpoint.
+
+    Defaults come from settings, rows of the model_limits table (editable in
+    the admin panel) override them at runtime for all workers.
+    """
+
+    def __init__(self, settings: CapacitySettings):
+        self.default_limits = {
+            AIModel.flux_schnell: settings.fal_flux_schnell_limit,
+            AIModel.sd3_image_to_image: settings.fal_sd3_image_to_image_limit,
+        }
+
+    def free_slots(self, limits: dict[str, int], generating: dict[str, int]) -> dict[AIModel, int]:
+        free = {}
+        for model, default_limit in self.default_limits.items():
+            limit = limits.get(model.value, default_limit)
+            free[model] = max(0, limit - generating.get(model.value, 0))
+        return free
+
+
+capacity = CapacityScheduler(CapacitySettings())
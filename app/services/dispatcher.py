@@ -0,0 +1,56 @@
+from typing import Awaitable, Callable
+from loguru import logger
+from pydantic_settings import BaseSettings
+import asyncio
+
+from app.db.listener import pg_listener
+
+
+class DispatcherSettings(BaseSettings):
+    dispatch_sweep_interval: float = 15
+
+
+class QueueDispatcher:
+    """Runs the queue handler as soon as something signals free work or capacity.
+
+    The handler is woken by `wake()` (same process) or by a NOTIFY on the
+    queue channel (any process). The sweep interval is only a fallback for
+    lost notifications.
+    """
+
+    def __init__(self, sweep_interval: float):
+        self.sweep_interval = sweep_interval
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self, *args):
+        self._wakeup.set()
+
+    def start(self, handler: Callable[[], Awaitable[None]]):
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run(handler))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self, handler: Callable[[], Awaitable[None]]):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.sweep_interval)
+            except TimeoutError:
+                await pg_listener.ensure_connected()
+            self._wakeup.clear()
+            try:
+                await handler()
+            except Exception as e:
+                logger.exception(e)
+
+
+dispatcher = QueueDispatcher(DispatcherSettings().dispatch_sweep_interval)
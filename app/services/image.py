@@ -1,150 +1,474 @@
-from fastapi import Depends, HTTPException
-from uuid import UUID
+from fastapi import Depends, HTTPException, UploadFile
+from pydantic_settings import BaseSettings
+from typing import AsyncIterator
+from uuid import UUID, uuid4
+from fal_client.client import FalClientError
 from loguru import logger
+from sqlalchemy import func
 import asyncio
 import datetime as dt
 import random
-import io
 
 from app.repositories.ai import AIRepository
 from app.repositories.image import ImageRepository
-from app.schemas.image import ImageTaskCreateSchema, ImageTaskSchema
-from app.schemas.ai import AIInputSchema, AIOutputSchema
-from app.db.base import get_session
-from app.db.tables import Image
+from app.repositories.image_cache import ImageCacheRepository
+from app.repositories.model_limit import ModelLimitRepository
+from app.repositories.source_upload import SourceUploadRepository
+from app.services.admission import admission
+from app.services.callbacks import check_callback_url
+from app.services.capacity import capacity
+from app.services.dispatcher import dispatcher
+from app.services.notifier import completion_settings, completions
+from app.services.image_processing import PASSTHROUGH_FORMATS, inspect_upload, preprocess_source
+from app.services.task_cache import CachedTask, task_cache
+from app.services.write_behind import status_writes
+from app.services.source_cache import source_cache_settings, source_urls
+from app.services.result_cache import result_cache_key, result_cache_settings, seed_from_key
+from app.schemas.image import (
+    ImageTaskCreateSchema, ImageTaskSchema, ImageBatchCreateSchema, ImageBatchSchema, ImageSize, IMAGE_SIZE_DIMENSIONS
+)
+from app.schemas.ai import AIInputSchema, AIOutputSchema, AIModel, MAX_NUM_IMAGES
+from app.db.tables import Image, ImageStatus
+
+
+class ImageQueueSettings(BaseSettings):
+    submit_concurrency: int = 10
+    submit_lease_seconds: int = 300
+    priority_aging_seconds: int = 60
+    bundle_weights: dict[str, float] = {}
+    reconcile_interval: int = 60
+    reconcile_stale_seconds: int = 120
+    reconcile_deadline_seconds: int = 60 * 60
+    reconcile_batch_size: int = 100
+    reconcile_concurrency: int = 10
+
+
+queue_settings = ImageQueueSettings()
 
 
 class ImageService:
     def __init__(
             self,
             ai_repository: AIRepository = Depends(),
-            image_repository: ImageRepository = Depends()
+            image_repository: ImageRepository = Depends(),
+            image_cache_repository: ImageCacheRepository = Depends(),
+            source_upload_repository: SourceUploadRepository = Depends()
     ):
         self.ai_repository = ai_repository
         self.image_repository = image_repository
+        self.image_cache_repository = image_cache_repository
+        self.source_upload_repository = source_upload_repository
 
-    async def create(self, schema: ImageTaskCreateSchema) -> ImageTaskSchema:
-        model = await self.image_repository.create(
+    async def _create_task(
+            self,
+            schema: ImageTaskCreateSchema,
+            model: AIModel,
+            resource_image_url: str | None = None,
+            eta: float | None = None
+    ) -> ImageTaskSchema:
+        fields = dict(
             user_id=schema.user_id,
             app_bundle=schema.app_bundle,
             prompt=schema.prompt,
-            image_size=schema.image_size.value
+            image_size=schema.image_size.value,
+            resource_image_url=resource_image_url,
+            priority=schema.priority,
+            model=model.value,
+            callback_url=str(schema.callback_url) if schema.callback_url else None,
+            expires_at=self._expires_at(schema.deadline, schema.ttl_seconds)
         )
-        return ImageTaskSchema.model_validate(model)
+        if schema.deterministic:
+            fields["cache_key"] = result_cache_key(
+                model.value, schema.prompt, schema.image_size.value, resource_image_url
+            )
+            image_url = await self.image_cache_repository.hit(
+                fields["cache_key"],
+                dt.timedelta(seconds=result_cache_settings.result_cache_ttl_seconds)
+            )
+            if image_url is not None:
+                fields.update(status=ImageStatus.finished, image_url=image_url)
+            else:
+                await self._attach_to_leader(fields)
+        image = await self.image_repository.create(**fields)
+        if image.status is None and image.leader_id is None:
+            dispatcher.wake()
+        task = ImageTaskSchema.model_validate(image)
+        if image.status is None:
+            task.eta_seconds = eta
+        return task
 
-    async def create_img2img(self, schema: ImageTaskCreateSchema, image_body: io.BytesIO) -> ImageTaskSchema:
-        image_url = await self.ai_repository.upload_image(image_body)
-        model = await self.image_repository.create(
-            user_id=schema.user_id,
-            app_bundle=schema.app_bundle,
-            prompt=schema.prompt,
-            image_size=schema.image_size,
-            resource_image_url=image_url
-        )
-        return ImageTaskSchema.model_validate(model)
+    @staticmethod
+    def _expires_at(deadline: dt.datetime | None, ttl_seconds: int | None):
+        """The earlier of the deadline and the end of the ttl.
 
-    async def _send_image2image(self, schema: ImageTaskCreateSchema, image_url: str, image_id: UUID):
-        request = AIInputSchema(
-            prompt=schema.prompt,
-            image_size=schema.image_size.value,
-            seed=random.randint(0, 999999999)
-        )
+        The ttl is counted by the database clock, which expires the images.
+        A deadline without a time zone is taken as UTC.
+        """
+        limits = []
+        if deadline is not None:
+            limits.append(deadline if deadline.tzinfo is not None else deadline.replace(tzinfo=dt.UTC))
+        if ttl_seconds is not None:
+            limits.append(func.now() + dt.timedelta(seconds=ttl_seconds))
+        if not limits:
+            return None
+        return func.least(*limits) if len(limits) > 1 else limits[0]
 
-        logger.debug("Sending submit request to AI: " + str(request.model_dump()))
-        try:
-            response = await self.ai_repository.submit_img2img(request, image_url, str(image_id))
-            logger.debug("Received response: " + str(response))
-        except TimeoutError:
-            await self.image_repository.update(
-                str(image_id),
-                is_finished=False,
-                is_invalid=True,
-                comment="Timeout"
+    async def _attach_to_leader(self, fields: dict):
+        """Make the task follow an identical in-flight task instead of generating it again"""
+        leader = await self.image_repository.find_leader(fields["cache_key"])
+        if leader is None:
+            return
+        fields.update(leader_id=leader.id, output_index=leader.output_index)
+        if leader.status == ImageStatus.queued:
+            fields.update(status=ImageStatus.queued, request_id=leader.request_id)
+
+    async def create(self, schema: ImageTaskCreateSchema) -> ImageTaskSchema:
+        await check_callback_url(schema.callback_url)
+        eta = await admission.admit()
+        return await self._create_task(schema, AIModel.flux_schnell, eta=eta)
+
+    async def create_img2img(self, schema: ImageTaskCreateSchema, file: UploadFile) -> ImageTaskSchema:
+        await check_callback_url(schema.callback_url)
+        eta = await admission.admit()
+        image_url = await self._upload_source(file, schema.image_size)
+        return await self._create_task(schema, AIModel.sd3_image_to_image, image_url, eta)
+
+    async def _upload_source(self, file: UploadFile, image_size: ImageSize) -> str:
+        """Upload the img2img source to fal storage.
+
+        The source is scaled and cropped to the generated size in the process pool,
+        sources already matching it are streamed to fal untouched.
+        Sources uploaded before are found by content hash and not uploaded again.
+        """
+        source = await inspect_upload(file)
+        size = IMAGE_SIZE_DIMENSIONS[image_size]
+        digest = await source.digest(image_size.value)
+        image_url = source_urls.get(digest)
+        if image_url is None:
+            image_url = await self.source_upload_repository.hit(
+                digest, dt.timedelta(seconds=source_cache_settings.source_cache_ttl_seconds)
             )
-            return schema
-        except Exception as e:
-            logger.exception(e)
-            await self.image_repository.update(
-                str(image_id),
-                is_finished=False,
-                is_invalid=True,
-                comment=str(e)
+        if image_url is not None:
+            source_urls.set(digest, image_url)
+            return image_url
+
+        if not source.needs_preprocessing(size):
+            image_url = await self.ai_repository.upload_image(
+                source.iter_chunks(), source.size, PASSTHROUGH_FORMATS[source.format]
             )
-            return schema
+        else:
+            data, content_type = await preprocess_source(source, size)
 
-        await self.image_repository.update(
-            str(image_id),
-            request_id=str(response),
-            is_finished=False
-        )
+            async def single_chunk():
+                yield data
+
+            image_url = await self.ai_repository.upload_image(single_chunk(), len(data), content_type)
+        await self.source_upload_repository.store(digest, image_url)
+        source_urls.set(digest, image_url)
+        return image_url
+
+    async def create_batch(self, schema: ImageBatchCreateSchema) -> ImageBatchSchema:
+        await check_callback_url(schema.callback_url)
+        eta = await admission.admit(len(schema.prompts) * schema.num_images)
+        batch_id = uuid4()
+        models = await self.image_repository.create_many([
+            dict(
+                user_id=schema.user_id,
+                app_bundle=schema.app_bundle,
+                prompt=prompt,
+                image_size=schema.image_size.value,
+                priority=schema.priority,
+                model=AIModel.flux_schnell.value,
+                batch_id=batch_id,
+                callback_url=str(schema.callback_url) if schema.callback_url else None
+            )
+            for prompt in schema.prompts
+            for _ in range(schema.num_images)
+        ], expires_at=self._expires_at(schema.deadline, schema.ttl_seconds))
+        dispatcher.wake()
+        tasks = [ImageTaskSchema.model_validate(model) for model in models]
+        for task in tasks:
+            task.eta_seconds = eta
+        return ImageBatchSchema(id=batch_id, tasks=tasks)
 
-    async def _send(self, schema: ImageTaskCreateSchema, image_id: UUID):
+    async def get_batch(self, batch_id: UUID) -> ImageBatchSchema:
+        models = await self.image_repository.list_batch(batch_id)
+        if not models:
+            raise HTTPException(404)
+        return ImageBatchSchema(id=batch_id, tasks=await self._with_eta(models))
+
+    @staticmethod
+    async def _with_eta(models: list[Image]) -> list[ImageTaskSchema]:
+        """Validate the tasks, those still in the queue get the ETA of the whole queue as an upper bound"""
+        tasks = [ImageTaskSchema.model_validate(model) for model in models]
+        if any(model.status is None for model in models):
+            await admission.refresh()
+            for model, task in zip(models, tasks):
+                if model.status is None:
+                    task.eta_seconds = admission.eta()
+        return tasks
+
+    async def _send(self, images: list[Image]):
+        """Submit images sharing prompt and size as one fal request"""
+        image = images[0]
         request = AIInputSchema(
-            prompt=schema.prompt,
-            image_size=schema.image_size.value,
-            seed=random.randint(0, 999999999)
+            prompt=image.prompt,
+            image_size=image.image_size,
+            seed=seed_from_key(image.cache_key) if image.cache_key else random.randint(0, 999999999),
+            num_images=len(images)
         )
 
         logger.debug("Sending submit request to AI: " + str(request.model_dump()))
         try:
-            response = await self.ai_repository.submit(request, str(image_id))
+            if image.model == AIModel.sd3_image_to_image.value:
+                response = await self.ai_repository.submit_img2img(request, image.resource_image_url, str(image.id))
+            else:
+                response = await self.ai_repository.submit(request, str(image.id))
             logger.debug("Received response: " + str(response))
         except TimeoutError:
-            await self.image_repository.update(
-                str(image_id),
-                is_finished=False,
-                is_invalid=True,
-                comment="Timeout"
-            )
-            return schema
+            await self._write_back(images, status=ImageStatus.error, comment="Timeout")
+            return
         except Exception as e:
             logger.exception(e)
-            await self.image_repository.update(
-                str(image_id),
-                is_finished=False,
-                is_invalid=True,
-                comment=str(e)
-            )
-            return schema
+            await self._write_back(images, status=ImageStatus.error, comment=str(e))
+            return
 
-        await self.image_repository.update(
-            str(image_id),
-            request_id=str(response),
-            is_finished=False
-        )
+        # The n-th image takes the n-th output
+        await status_writes.write([
+            dict(id=image.id, status=ImageStatus.queued, request_id=str(response), output_index=index)
+            for index, image in enumerate(images)
+        ])
 
     async def store_ai_output(self, schema: AIOutputSchema, image_id: UUID):
-        await self.image_repository.update(
-            str(image_id),
-            is_finished=True,
-            image_url=schema.payload.images[0].url
-        )
+        if await self.image_repository.hold_early_output(image_id, schema):
+            # Delivered before the submit result was stored, applied when it is
+            return
+        if schema.payload is None:
+            logger.warning(f"fal request {schema.request_id} failed: {schema.error}")
+            await self.image_repository.fail_request(schema.request_id, schema.error)
+            dispatcher.wake()
+            return
+        rows = await self.image_repository.finish_request(schema.request_id, schema)
+        if not rows:
+            return
+        for row in rows:
+            completions.notify(str(row.id))
+        if any(row.cache_key is not None for row in rows):
+            # Followers attached while the update waited on their leader's lock
+            # are not visible to it, a second statement picks them up
+            await self.image_repository.finish_request(schema.request_id, schema)
+            await self.image_cache_repository.store_request(schema.request_id)
+        dispatcher.wake()
+
+    async def cancel(self, image_id: UUID) -> ImageTaskSchema:
+        """Cancel a task that is not done yet.
+
+        The fal request is cancelled too, unless other images still wait for
+        it: followers of the task (one of them takes over as leader) or
+        images of the same batch sharing the request.
+        """
+        image = await self.image_repository.cancel(image_id)
+        if image.status == ImageStatus.queued and image.follower_count == 0:
+            try:
+                await self.ai_repository.cancel(image.model, image.request_id)
+            except Exception as e:
+                logger.warning(f"Cancelling fal request {image.request_id} failed: {e!r}")
+        dispatcher.wake()
+        return await self.get(image_id)
 
     async def get(self, image_id: UUID) -> ImageTaskSchema:
         model = await self.image_repository.get(str(image_id))
-        return ImageTaskSchema.model_validate(model)
+        return (await self._with_eta([model]))[0]
+
+    async def get_finished(self, image_id: UUID) -> Image:
+        model = await self.image_repository.get(str(image_id))
+        if model.status != ImageStatus.finished:
+            raise HTTPException(404)
+        return model
+
+    async def get_cached(self, image_id: UUID) -> CachedTask:
+        """Return the serialized task, reading the database only on a cache miss"""
+        cached = await task_cache.get(str(image_id))
+        if cached is None:
+            cached = CachedTask.from_schema(await self.get(image_id))
+            await task_cache.set(str(image_id), cached)
+        return cached
+
+    @staticmethod
+    async def _load_tasks(image_ids: list[UUID]) -> list[ImageTaskSchema]:
+        """Read the images in a short session, so waiting clients never hold a connection"""
+        async with ImageRepository() as image_repository:
+            models = await image_repository.list_by_ids(image_ids)
+            return [ImageTaskSchema.model_validate(model) for model in models]
+
+    async def wait(self, image_id: UUID, timeout: float) -> ImageTaskSchema:
+        """Return the task once it is done or the timeout passed"""
+        with completions.watch([str(image_id)]) as done:
+            tasks = await self._load_tasks([image_id])
+            if not tasks:
+                raise HTTPException(404)
+            if tasks[0].is_finished or tasks[0].is_invalid:
+                return tasks[0]
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+            except TimeoutError:
+                return tasks[0]
+        return (await self._load_tasks([image_id]))[0]
+
+    async def stream(self, image_ids: list[UUID]) -> AsyncIterator[str]:
+        """Return a server-sent events stream with an event for every task once it is done"""
+        tasks = await self._load_tasks(image_ids)
+        if not tasks:
+            raise HTTPException(404)
+        return self._stream_events([task.id for task in tasks])
+
+    async def _stream_events(self, image_ids: list[UUID]) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        closes_at = loop.time() + completion_settings.stream_max_seconds
+        pending = set(image_ids)
+        with completions.watch([str(image_id) for image_id in image_ids]) as done:
+            while pending and loop.time() < closes_at:
+                done.clear()
+                for task in await self._load_tasks(list(pending)):
+                    if task.is_finished or task.is_invalid:
+                        pending.discard(task.id)
+                        yield f"event: image\ndata: {task.model_dump_json()}\n\n"
+                if not pending:
+                    break
+                try:
+                    await asyncio.wait_for(done.wait(), completion_settings.stream_keepalive_seconds)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+
+    @staticmethod
+    async def _write_back(images: list[Image], **data):
+        """Store a submission outcome through the write buffer, it never shares a session with other submits"""
+        await status_writes.write([dict(id=image.id, **data) for image in images])
+
+    async def _collapse_batches(self, model: AIModel, images: list[Image], lease: dt.timedelta) -> list[list[Image]]:
+        """Group claimed images of a batch with equal prompt and size into shared fal requests.
+
+        Unsended siblings are claimed along with a group until it fills the
+        model's num_images, so a batch takes far fewer fal slots than images.
+        """
+        max_num_images = MAX_NUM_IMAGES[model]
+        submissions = []
+        groups: dict[tuple, list[Image]] = {}
+        for image in images:
+            if image.batch_id is None or max_num_images == 1:
+                submissions.append([image])
+            else:
+                groups.setdefault((image.batch_id, image.prompt, image.image_size), []).append(image)
+        for group in groups.values():
+            missing = -len(group) % max_num_images
+            if missing:
+                group += await self.image_repository.claim_batch_siblings(group[0], missing, lease)
+            submissions += [group[i:i + max_num_images] for i in range(0, len(group), max_num_images)]
+        return submissions
+
+    async def _submit_all(self, submissions: list[list[Image]]):
+        """Send every submission at once, bounded by submit_concurrency"""
+        semaphore = asyncio.Semaphore(queue_settings.submit_concurrency)
+
+        async def submit(images: list[Image]):
+            async with semaphore:
+                try:
+                    await self._send(images)
+                except Exception as e:
+                    logger.exception(e)
+
+        async with asyncio.TaskGroup() as group:
+            for images in submissions:
+                group.create_task(submit(images))
+
+    @classmethod
+    async def _in_session(cls, image_repository: ImageRepository) -> "ImageService":
+        """Build the service for background work, all repositories share the session"""
+        return cls(
+            ai_repository=AIRepository(),
+            image_repository=image_repository,
+            image_cache_repository=await ImageCacheRepository().child(session=image_repository.session),
+            source_upload_repository=await SourceUploadRepository().child(session=image_repository.session)
+        )
 
     @classmethod
     async def process_images_queue(cls):
-        session_getter = get_session()
-        db_session = await anext(session_getter)
-        self = cls(ai_repository=AIRepository(), image_repository=ImageRepository(session=db_session))
+        async with ImageRepository() as image_repository:
+            self = await cls._in_session(image_repository)
 
-        generating_count = await self.image_repository.count_generating_images()
-        if generating_count >= 5:
-            return
-        images = await self.image_repository.list_unsended()
-        if not images:
+            limit_repository = await ModelLimitRepository().child(session=image_repository.session)
+            await self.image_repository.lock_queue()
+            expired = await self.image_repository.expire_unsended()
+            if expired:
+                logger.info(f"Expired {expired} images past their deadline")
+            await self.image_repository.promote_orphans()
+            free_slots = capacity.free_slots(
+                await limit_repository.get_limits(),
+                await self.image_repository.count_generating_images()
+            )
+            lease = dt.timedelta(seconds=queue_settings.submit_lease_seconds)
+            submissions = []
+            for model, count in free_slots.items():
+                if count > 0:
+                    images = await self.image_repository.claim_unsended(
+                        model.value,
+                        count,
+                        lease,
+                        dt.timedelta(seconds=queue_settings.priority_aging_seconds),
+                        queue_settings.bundle_weights
+                    )
+                    submissions += await self._collapse_batches(model, images, lease)
+            await self.image_repository.commit()
+        if submissions:
+            await self._submit_all(submissions)
+        if any(len(images) > 1 for images in submissions):
+            # Collapsed batches hold fewer fal slots than they claimed
+            dispatcher.wake()
+
+    @classmethod
+    async def reconcile_queued(cls):
+        """Complete fal requests whose webhook never arrived.
+
+        Requests queued for longer than reconcile_stale_seconds are checked on
+        fal. Finished ones are stored like a webhook would, requests failed on
+        fal or still unfinished after reconcile_deadline_seconds become errors.
+        """
+        async with ImageRepository() as image_repository:
+            rows = await image_repository.claim_stale_requests(
+                dt.timedelta(seconds=queue_settings.reconcile_stale_seconds),
+                dt.timedelta(seconds=queue_settings.reconcile_deadline_seconds),
+                queue_settings.reconcile_batch_size
+            )
+            await image_repository.drop_early_outputs(dt.timedelta(seconds=queue_settings.reconcile_deadline_seconds))
+        requests = {row.request_id: row for row in rows}
+        if not requests:
             return
-        for image in images[:5 - generating_count]:
-            schema = ImageTaskCreateSchema.model_validate(image)
-            if image.resource_image_url is not None:
-                await self._send_image2image(schema, image.resource_image_url, image.id)
-            else:
-                await self._send(schema, image.id)
+        logger.info(f"Reconciling {len(requests)} stale fal requests")
+        ai_repository = AIRepository()
+        semaphore = asyncio.Semaphore(queue_settings.reconcile_concurrency)
 
-        try:
-            await anext(session_getter)
-        except StopAsyncIteration:
-            pass
+        async def reconcile(row):
+            async with semaphore:
+                try:
+                    if await ai_repository.is_finished(row.model, row.request_id):
+                        try:
+                            output = await ai_repository.get_output(row.model, row.request_id)
+                        except FalClientError as e:
+                            await cls._fail_request(row.request_id, str(e))
+                            return
+                        async with ImageRepository() as image_repository:
+                            self = await cls._in_session(image_repository)
+                            await self.store_ai_output(output, row.id)
+                    elif row.expired:
+                        await cls._fail_request(row.request_id, "Deadline exceeded")
+                except Exception as e:
+                    logger.exception(e)
+
+        async with asyncio.TaskGroup() as group:
+            for row in requests.values():
+                group.create_task(reconcile(row))
 
+    @staticmethod
+    async def _fail_request(request_id: str, comment: str):
+        async with ImageRepository() as image_repository:
+            await image_repository.fail_request(request_id, comment)
@@ -0,0 +1,195 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator
+from fastapi import HTTPException, UploadFile
+from loguru import logger
+from PIL import Image, ImageOps, features
+from pydantic_settings import BaseSettings
+import asyncio
+import hashlib
+import io
+
+
+class ImageProcessingSettings(BaseSettings):
+    max_upload_bytes: int = 20 * 1024 * 1024
+    max_source_pixels: int = 50_000_000
+    source_format: str = "JPEG"
+    source_quality: int = 90
+    upload_chunk_size: int = 64 * 1024
+    upload_header_limit: int = 512 * 1024
+    processing_workers: int = 2
+    variant_thumbnail_sides: list[int] = [256, 512]
+    variant_quality: int = 80
+    variant_avif: bool = True
+
+
+processing_settings = ImageProcessingSettings()
+
+# Formats fal accepts as is
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class PreprocessStats:
+    """Totals of the preprocessing stage since the process started"""
+
+    def __init__(self):
+        self.images = 0
+        self.source_bytes = 0
+        self.output_bytes = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.source_bytes - self.output_bytes
+
+    def record(self, source_bytes: int, output_bytes: int):
+        self.images += 1
+        self.source_bytes += source_bytes
+        self.output_bytes += output_bytes
+
+
+preprocess_stats = PreprocessStats()
+
+_pool: ProcessPoolExecutor | None = None
+
+
+async def run_in_pool(func, *args):
+    """Run CPU bound image work in a worker process, off the event loop"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=processing_settings.processing_workers)
+    return await asyncio.get_running_loop().run_in_executor(_pool, func, *args)
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+class SourceImage:
+    def __init__(self, file: UploadFile, image_format: str, width: int, height: int):
+        self.file = file
+        self.format = image_format
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self) -> int:
+        return self.file.size
+
+    def needs_preprocessing(self, size: tuple[int, int]) -> bool:
+        return self.format not in PASSTHROUGH_FORMATS or (self.width, self.height) != size
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        await self.file.seek(0)
+        while chunk := await self.file.read(processing_settings.upload_chunk_size):
+            yield chunk
+
+    async def digest(self, *params: str) -> str:
+        """SHA-256 of the processing params and the upload, computed chunk by chunk"""
+        digest = hashlib.sha256('\n'.join(params).encode())
+        async for chunk in self.iter_chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    async def read(self) -> bytes:
+        await self.file.seek(0)
+        return await self.file.read()
+
+
+async def inspect_upload(file: UploadFile) -> SourceImage:
+    """Validate size and format of the upload, reading only its header"""
+    if file.size is None or file.size > processing_settings.max_upload_bytes:
+        raise HTTPException(413, f"Image must not exceed {processing_settings.max_upload_bytes} bytes")
+
+    header = b""
+    image = None
+    while image is None and len(header) < processing_settings.upload_header_limit:
+        chunk = await file.read(processing_settings.upload_chunk_size)
+        if not chunk:
+            break
+        header += chunk
+        try:
+            # Image.open parses the header lazily, pixel data is never decoded here
+            image = Image.open(io.BytesIO(header))
+        except Image.DecompressionBombError:
+            raise HTTPException(413, "Image resolution is too large")
+        except Exception:
+            continue
+    if image is None:
+        raise HTTPException(415, "Unsupported image format")
+
+    width, height = image.size
+    if width * height > processing_settings.max_source_pixels:
+        raise HTTPException(413, "Image resolution is too large")
+    return SourceImage(file, image.format, width, height)
+
+
+def preprocess(data: bytes, size: tuple[int, int], image_format: str, quality: int) -> bytes:
+    """Scale and center crop the image to size, dropping its metadata. Runs in a worker process."""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG is decoded at a reduced scale right away, far cheaper than a full decode
+        image.draft("RGB", size)
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image.convert("RGB"), size, Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+async def preprocess_source(source: SourceImage, size: tuple[int, int]) -> tuple[bytes, str]:
+    """Fit the source to the generated image size, return the encoded bytes and their content type"""
+    data = await run_in_pool(
+        preprocess,
+        await source.read(),
+        size,
+        processing_settings.source_format,
+        processing_settings.source_quality
+    )
+    preprocess_stats.record(source.size, len(data))
+    logger.info(
+        f'Preprocessed {source.format} {source.width}x{source.height} to {size[0]}x{size[1]}: '
+        f'{source.size} -> {len(data)} bytes, {preprocess_stats.saved_bytes} bytes saved in total'
+    )
+    return data, Image.MIME[processing_settings.source_format]
+
+
+def avif_supported() -> bool:
+    try:
+        return features.check("avif")
+    except ValueError:
+        return False
+
+
+def make_variants(data: bytes, thumbnail_sides: list[int], quality: int, avif: bool) -> dict[str, tuple]:
+    """Encode the WebP thumbnails and full size WebP/AVIF copies of an image. Runs in a worker process.
+
+    Returns (data, width, height, content type) by variant name.
+    """
+    variants = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+
+        def encode(name: str, variant: Image.Image, image_format: str):
+            buffer = io.BytesIO()
+            variant.save(buffer, format=image_format, quality=quality)
+            variants[name] = (buffer.getvalue(), variant.width, variant.height, Image.MIME[image_format])
+
+        for side in thumbnail_sides:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((side, side), Image.Resampling.LANCZOS)
+            encode(f"thumbnail_{side}", thumbnail, "WEBP")
+        encode("webp", image, "WEBP")
+        if avif:
+            encode("avif", image, "AVIF")
+    return variants
+
+
+async def create_variants(data: bytes) -> dict[str, tuple]:
+    return await run_in_pool(
+        make_variants,
+        data,
+        processing_settings.variant_thumbnail_sides,
+        processing_settings.variant_quality,
+        processing_settings.variant_avif and avif_supported()
+    )
@@ -0,0 +1,129 @@
+from pathlib import Path
+from urllib.parse import urlsplit
+from loguru import logger
+import asyncio
+import datetime as dt
+import hashlib
+import httpx
+import mimetypes
+
+from app.repositories.image import ImageRepository
+from app.services.dispatcher import QueueDispatcher
+from app.services.image_processing import create_variants
+from app.services.storage import storage, storage_settings
+from app.services.task_cache import task_cache
+
+
+def file_key(image_url: str) -> str:
+    """Storage key of a fal output, a hash of its url, equal urls share one stored file"""
+    suffix = Path(urlsplit(image_url).path).suffix.lower() or ".jpg"
+    return hashlib.sha256(image_url.encode()).hexdigest() + suffix
+
+
+def variant_key(key: str, name: str, content_type: str) -> str:
+    return f"{Path(key).stem}.{name}.{content_type.removeprefix('image/')}"
+
+
+async def single_chunk(data: bytes):
+    yield data
+
+
+class ImageMirror:
+    """Streams finished images from fal into our storage, off the webhook path,
+    together with their thumbnail and WebP/AVIF variants.
+
+    Woken by the image_done notifications, with a periodic sweep for
+    images missed while no worker was listening.
+    """
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(60, connect=10),
+                limits=httpx.Limits(max_connections=storage_settings.mirror_concurrency),
+                follow_redirects=True
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _download(self, key: str, image_url: str, content_type: str) -> bytes:
+        """Save the image under the key and return its bytes"""
+        if await storage.exists(key):
+            return await storage.read(key)
+        data = bytearray()
+
+        async def chunks():
+            async for chunk in response.aiter_bytes():
+                data.extend(chunk)
+                yield chunk
+
+        async with self.client.stream("GET", image_url) as response:
+            response.raise_for_status()
+            await storage.save(key, chunks(), content_type)
+        return bytes(data)
+
+    async def _save_variants(self, key: str, data: bytes) -> dict:
+        """Encode the variants once and store them next to the original"""
+        variants = {}
+        for name, (variant, width, height, content_type) in (await create_variants(data)).items():
+            name_key = variant_key(key, name, content_type)
+            if not await storage.exists(name_key):
+                await storage.save(name_key, single_chunk(variant), content_type)
+            variants[name] = {
+                "key": name_key,
+                "width": width,
+                "height": height,
+                "content_type": content_type,
+                "size": len(variant)
+            }
+        return variants
+
+    async def _mirror(self, image_id, image_url: str) -> tuple | None:
+        key = file_key(image_url)
+        content_type = mimetypes.guess_type(key)[0] or "image/jpeg"
+        try:
+            data = await self._download(key, image_url, content_type)
+        except Exception as e:
+            logger.warning(f"Mirroring image {image_id} failed: {e!r}")
+            return None
+        try:
+            variants = await self._save_variants(key, data)
+        except Exception as e:
+            # The original is served without variants rather than mirrored again
+            logger.warning(f"Creating variants of image {image_id} failed: {e!r}")
+            variants = None
+        return image_id, key, content_type, variants
+
+    async def mirror_finished(self):
+        lease = dt.timedelta(seconds=storage_settings.mirror_lease_seconds)
+        semaphore = asyncio.Semaphore(storage_settings.mirror_concurrency)
+
+        async def mirror(row):
+            async with semaphore:
+                return await self._mirror(row.id, row.image_url)
+
+        while True:
+            async with ImageRepository() as image_repository:
+                rows = await image_repository.claim_unmirrored(
+                    storage_settings.mirror_batch_size, lease, storage_settings.mirror_max_attempts
+                )
+            if not rows:
+                return
+            files = [file for file in await asyncio.gather(*map(mirror, rows)) if file is not None]
+            if files:
+                async with ImageRepository() as image_repository:
+                    await image_repository.set_files(files)
+                for file in files:
+                    await task_cache.invalidate(str(file[0]))
+
+
+mirror = ImageMirror()
+mirror_dispatcher = QueueDispatcher(storage_settings.mirror_sweep_interval)
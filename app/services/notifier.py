@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from pydantic_settings import BaseSettings
+import asyncio
+
+
+class CompletionSettings(BaseSettings):
+    wait_max_timeout: float = 60
+    stream_keepalive_seconds: float = 15
+    stream_max_seconds: float = 600
+
+
+completion_settings = CompletionSettings()
+
+
+class CompletionNotifier:
+    """Wakes requests waiting for images to finish.
+
+    Fed by NOTIFY on the done channel, so completions stored by any worker
+    reach the waiters of every process.
+    """
+
+    def __init__(self):
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+
+    def notify(self, image_id: str):
+        for event in self._waiters.get(image_id, ()):
+            event.set()
+
+    @contextmanager
+    def watch(self, image_ids: list[str]):
+        """Yield an event set whenever one of the images is done"""
+        event = asyncio.Event()
+        for image_id in image_ids:
+            self._waiters.setdefault(image_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            for image_id in image_ids:
+                waiters = self._waiters.get(image_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[image_id]
+
+
+completions = CompletionNotifier()
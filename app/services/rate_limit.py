@@ -0,0 +1,137 @@
+from fastapi import HTTPException, status
+from limits import parse_many, RateLimitItem
+from loguru import logger
+from pydantic_settings import BaseSettings
+from redis.asyncio import Redis
+import hashlib
+import math
+import time
+
+from app.services.ttl_cache import TTLCache
+
+
+class RateLimitSettings(BaseSettings):
+    rate_limit_enabled: bool = True
+    rate_limit_redis_url: str | None = None
+    rate_limit_memory_entries: int = 100000
+    # Limits in the limits notation ("20/minute;300/hour") by route and by key
+    rate_limits: dict[str, dict[str, str]] = {
+        "create_image": {"access_token": "1200/minute", "app_bundle": "600/minute", "user_id": "20/minute;300/hour"},
+        "create_batch": {"access_token": "1200/minute", "app_bundle": "600/minute", "user_id": "100/minute;1000/hour"},
+        "improve_image": {"access_token": "600/minute", "app_bundle": "300/minute", "user_id": "10/minute;100/hour"},
+    }
+
+
+rate_limit_settings = RateLimitSettings()
+
+# Every limit is checked before any is counted, so rejected requests cost nothing.
+# KEYS are (current window, previous window) pairs, ARGV holds the cost and then
+# (limit, weight of the previous window, ttl) for every pair.
+SLIDING_WINDOW_SCRIPT = """
+local cost = tonumber(ARGV[1])
+for i = 1, #KEYS / 2 do
+    local current = tonumber(redis.call('GET', KEYS[2 * i - 1]) or '0')
+    local previous = tonumber(redis.call('GET', KEYS[2 * i]) or '0')
+    if current + previous * tonumber(ARGV[3 * i]) + cost > tonumber(ARGV[3 * i - 1]) then
+        return i
+    end
+end
+for i = 1, #KEYS / 2 do
+    redis.call('INCRBY', KEYS[2 * i - 1], cost)
+    redis.call('EXPIRE', KEYS[2 * i - 1], ARGV[3 * i + 1])
+end
+return 0
+"""
+
+
+class Window:
+    """One limit applied to one key, at the current moment"""
+
+    def __init__(self, prefix: str, item: RateLimitItem, now: float):
+        self.item = item
+        self.seconds = item.get_expiry()
+        index, elapsed = divmod(now, self.seconds)
+        self.current = f"{prefix}:{self.seconds}:{int(index)}"
+        self.previous = f"{prefix}:{self.seconds}:{int(index) - 1}"
+        # The previous window counts for the part of it still inside the sliding window
+        self.weight = 1 - elapsed / self.seconds
+        self.retry_after = math.ceil(self.seconds - elapsed)
+
+
+class RateLimiter:
+    """Sliding window counters per access token, app bundle and user id.
+
+    A request is counted in fixed windows, the count of the sliding window is
+    the current window plus the overlapping share of the previous one. Counters
+    live in Redis when configured, so the limits hold across workers; they fall
+    back to an in-process LRU when Redis is not configured or unavailable.
+    """
+
+    def __init__(self, redis_url: str | None):
+        self.limits = {
+            route: {key: parse_many(limit) for key, limit in keys.items()}
+            for route, keys in rate_limit_settings.rate_limits.items()
+        }
+        self.memory = TTLCache[int](rate_limit_settings.rate_limit_memory_entries, 0)
+        self.redis = Redis.from_url(redis_url) if redis_url else None
+        self.script = self.redis.register_script(SLIDING_WINDOW_SCRIPT) if self.redis is not None else None
+
+    @staticmethod
+    def _prefix(route: str, name: str, value: str) -> str:
+        # Hashed, so access tokens are not stored and keys stay short
+        return f"rate_limit:{route}:{name}:{hashlib.blake2b(value.encode(), digest_size=12).hexdigest()}"
+
+    def _windows(self, route: str, keys: dict[str, str]) -> list[Window]:
+        now = time.time()
+        return [
+            Window(self._prefix(route, name, keys[name]), item, now)
+            for name, items in self.limits.get(route, {}).items()
+            if name in keys
+            for item in items
+        ]
+
+    async def _hit_redis(self, windows: list[Window], cost: int) -> Window | None:
+        args = [cost]
+        for window in windows:
+            args += [window.item.amount, window.weight, 2 * window.seconds]
+        exceeded = await self.script(keys=[key for w in windows for key in (w.current, w.previous)], args=args)
+        return windows[exceeded - 1] if exceeded else None
+
+    def _hit_memory(self, windows: list[Window], cost: int) -> Window | None:
+        for window in windows:
+            current = self.memory.get(window.current) or 0
+            previous = self.memory.get(window.previous) or 0
+            if current + previous * window.weight + cost > window.item.amount:
+                return window
+        for window in windows:
+            self.memory.set(window.current, (self.memory.get(window.current) or 0) + cost, 2 * window.seconds)
+        return None
+
+    async def hit(self, route: str, cost: int = 1, **keys: str):
+        """Count a request of the route, raise 429 when any of its limits is exceeded"""
+        if not rate_limit_settings.rate_limit_enabled:
+            return
+        windows = self._windows(route, keys)
+        if not windows:
+            return
+        if self.redis is not None:
+            try:
+                exceeded = await self._hit_redis(windows, cost)
+            except Exception as e:
+                logger.warning(f"Rate limit Redis is unavailable: {e}")
+                exceeded = self._hit_memory(windows, cost)
+        else:
+            exceeded = self._hit_memory(windows, cost)
+        if exceeded is not None:
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                f"Rate limit exceeded: {exceeded.item}",
+                headers={"Retry-After": str(exceeded.retry_after)}
+            )
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+rate_limiter = RateLimiter(rate_limit_settings.rate_limit_redis_url)
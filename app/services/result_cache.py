@@ -0,0 +1,25 @@
+from pydantic_settings import BaseSettings
+import hashlib
+
+
+class ResultCacheSettings(BaseSettings):
+    result_cache_ttl_seconds: int = 24 * 60 * 60
+    result_cache_max_entries: int = 100000
+    result_cache_evict_interval: int = 60 * 60
+
+
+result_cache_settings = ResultCacheSettings()
+
+
+def normalize_prompt(prompt: str) -> str:
+    return ' '.join(prompt.split())
+
+
+def result_cache_key(model: str, prompt: str, image_size: str, resource_image_url: str | None = None) -> str:
+    """Content hash of everything that determines a deterministic generation"""
+    content = '\n'.join([model, image_size, normalize_prompt(prompt), resource_image_url or ''])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def seed_from_key(key: str) -> int:
+    return int(key[:15], 16) % 1000000000
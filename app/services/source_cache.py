@@ -0,0 +1,15 @@
+from pydantic_settings import BaseSettings
+
+from app.services.ttl_cache import TTLCache
+
+
+class SourceCacheSettings(BaseSettings):
+    source_cache_ttl_seconds: int = 24 * 60 * 60
+    source_cache_max_entries: int = 100000
+    source_cache_memory_entries: int = 1024
+
+
+source_cache_settings = SourceCacheSettings()
+
+
+source_urls = TTLCache[str](source_cache_settings.source_cache_memory_entries, source_cache_settings.source_cache_ttl_seconds)
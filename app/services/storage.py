@@ -0,0 +1,116 @@
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterable
+from pydantic_settings import BaseSettings
+import asyncio
+import os
+import uuid
+
+
+class StorageSettings(BaseSettings):
+    storage_backend: str | None = None  # "local" or "s3", mirroring is off without one
+    storage_local_dir: str = "storage"
+    storage_s3_bucket: str | None = None
+    storage_s3_endpoint_url: str | None = None
+    storage_s3_region: str | None = None
+    storage_s3_url_expires_seconds: int = 60 * 60
+    storage_max_age: int = 365 * 24 * 60 * 60
+    mirror_sweep_interval: float = 60
+    mirror_batch_size: int = 50
+    mirror_concurrency: int = 8
+    mirror_lease_seconds: int = 300
+    mirror_max_attempts: int = 5
+
+
+storage_settings = StorageSettings()
+
+# Stored files are never replaced under their key, so they can be cached forever
+IMMUTABLE_CACHE_CONTROL = f"public, max-age={storage_settings.storage_max_age}, immutable"
+
+
+class LocalStorage:
+    """Files in a local directory, served with FileResponse"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(self.path(key).exists)
+
+    async def read(self, key: str) -> bytes:
+        return await asyncio.to_thread(self.path(key).read_bytes)
+
+    async def save(self, key: str, chunks: AsyncIterable[bytes], content_type: str):
+        path = self.path(key)
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        # Written under a temporary name, so a file is never served half written
+        partial = path.with_name(f".{uuid.uuid4()}.part")
+        file = await asyncio.to_thread(open, partial, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+        except BaseException:
+            await asyncio.to_thread(file.close)
+            await asyncio.to_thread(partial.unlink, missing_ok=True)
+            raise
+        await asyncio.to_thread(file.close)
+        await asyncio.to_thread(os.replace, partial, path)
+
+
+class S3Storage:
+    """Objects in an S3 compatible bucket, served by redirecting to a presigned url.
+
+    Needs boto3, which is only imported when this backend is configured.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: str | None, region: str | None):
+        import boto3
+
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+
+    async def read(self, key: str) -> bytes:
+        response = await asyncio.to_thread(self.client.get_object, Bucket=self.bucket, Key=key)
+        return await asyncio.to_thread(response["Body"].read)
+
+    async def save(self, key: str, chunks: AsyncIterable[bytes], content_type: str):
+        with SpooledTemporaryFile(max_size=8 * 1024 * 1024) as file:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+            await asyncio.to_thread(file.seek, 0)
+            await asyncio.to_thread(
+                self.client.upload_fileobj, file, self.bucket, key,
+                ExtraArgs={"ContentType": content_type, "CacheControl": IMMUTABLE_CACHE_CONTROL}
+            )
+
+    def url(self, key: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=storage_settings.storage_s3_url_expires_seconds
+        )
+
+
+def create_storage() -> LocalStorage | S3Storage | None:
+    if storage_settings.storage_backend == "local":
+        return LocalStorage(storage_settings.storage_local_dir)
+    if storage_settings.storage_backend == "s3":
+        return S3Storage(
+            storage_settings.storage_s3_bucket,
+            storage_settings.storage_s3_endpoint_url,
+            storage_settings.storage_s3_region
+        )
+    return None
+
+
+storage = create_storage()
@@ -0,0 +1,101 @@
+from typing import NamedTuple
+from loguru import logger
+from pydantic_settings import BaseSettings
+from redis.asyncio import Redis
+import hashlib
+
+from app.schemas.image import ImageTaskSchema
+from app.services.ttl_cache import TTLCache
+
+
+class TaskCacheSettings(BaseSettings):
+    task_cache_memory_entries: int = 10000
+    task_cache_done_ttl_seconds: int = 24 * 60 * 60
+    task_cache_pending_ttl_seconds: float = 1
+    task_cache_http_max_age: int = 300
+    task_cache_redis_url: str | None = None
+
+
+task_cache_settings = TaskCacheSettings()
+
+
+class CachedTask(NamedTuple):
+    body: str
+    etag: str
+    is_done: bool
+
+    @classmethod
+    def from_schema(cls, task: ImageTaskSchema) -> "CachedTask":
+        body = task.model_dump_json()
+        return cls(body, cls.make_etag(body), task.is_finished or task.is_invalid)
+
+    @staticmethod
+    def make_etag(body: str) -> str:
+        return '"' + hashlib.blake2b(body.encode(), digest_size=16).hexdigest() + '"'
+
+
+class TaskCache:
+    """Serialized tasks in an in-process LRU, backed by Redis when configured.
+
+    Done tasks never change, they are kept for task_cache_done_ttl_seconds
+    in both tiers. Tasks in progress are kept in memory for a moment only.
+    Entries are dropped when an image is done or updated.
+    """
+
+    def __init__(self, redis_url: str | None):
+        self.memory = TTLCache[CachedTask](
+            task_cache_settings.task_cache_memory_entries,
+            task_cache_settings.task_cache_done_ttl_seconds
+        )
+        self.redis = Redis.from_url(redis_url) if redis_url else None
+
+    @staticmethod
+    def _redis_key(image_id: str) -> str:
+        return f"image_task:{image_id}"
+
+    async def get(self, image_id: str) -> CachedTask | None:
+        cached = self.memory.get(image_id)
+        if cached is not None or self.redis is None:
+            return cached
+        try:
+            body = await self.redis.get(self._redis_key(image_id))
+        except Exception as e:
+            logger.warning(f"Task cache Redis is unavailable: {e}")
+            return None
+        if body is None:
+            return None
+        cached = CachedTask(body.decode(), CachedTask.make_etag(body.decode()), True)
+        self.memory.set(image_id, cached)
+        return cached
+
+    async def set(self, image_id: str, cached: CachedTask):
+        if not cached.is_done:
+            self.memory.set(image_id, cached, task_cache_settings.task_cache_pending_ttl_seconds)
+            return
+        self.memory.set(image_id, cached)
+        if self.redis is not None:
+            try:
+                await self.redis.set(
+                    self._redis_key(image_id), cached.body, ex=task_cache_settings.task_cache_done_ttl_seconds
+                )
+            except Exception as e:
+                logger.warning(f"Task cache Redis is unavailable: {e}")
+
+    def forget(self, image_id: str):
+        """Drop the in-process entry, called for every image done in any worker"""
+        self.memory.pop(image_id)
+
+    async def invalidate(self, image_id: str):
+        self.forget(image_id)
+        if self.redis is not None:
+            try:
+                await self.redis.delete(self._redis_key(image_id))
+            except Exception as e:
+                logger.warning(f"Task cache Redis is unavailable: {e}")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+task_cache = TaskCache(task_cache_settings.task_cache_redis_url)
@@ -0,0 +1,115 @@
+from loguru import logger
+from pydantic_settings import BaseSettings
+import asyncio
+
+from app.repositories.image import ImageRepository
+
+
+class WriteBehindSettings(BaseSettings):
+    write_behind_enabled: bool = False
+    write_behind_delay_ms: float = 5
+    write_behind_max_batch: int = 500
+    write_behind_retries: int = 2
+    write_behind_retry_delay_ms: float = 50
+
+
+class StatusWriteBuffer:
+    """Collects image status transitions for a few milliseconds and stores them with one bulk UPDATE.
+
+    `write()` returns only once its transitions are committed, so nothing is
+    acknowledged before it is stored. Disabled, every write is stored at once.
+
+    Failed statements are retried. A batch that still fails is stored write by
+    write, so one bad write can not lose the outcomes of submits fal accepted.
+    """
+
+    def __init__(self, enabled: bool, delay: float, max_batch: int, retries: int, retry_delay: float):
+        self.enabled = enabled
+        self.delay = delay
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._writes: list[tuple[list[dict], asyncio.Future]] = []
+        self._size = 0
+        self._flushes: set[asyncio.Task] = set()
+
+    async def _store(self, transitions: list[dict]):
+        for attempt in range(self.retries + 1):
+            try:
+                async with ImageRepository() as image_repository:
+                    await image_repository.write_transitions(transitions)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Storing {len(transitions)} status transitions failed, retrying: {e!r}")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def write(self, transitions: list[dict]):
+        if not self.enabled:
+            await self._store(transitions)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._writes:
+            self._schedule(self._flush_later())
+        self._writes.append((transitions, waiter))
+        self._size += len(transitions)
+        if self._size >= self.max_batch:
+            self._schedule(self.flush())
+        await waiter
+
+    def _schedule(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    async def flush(self):
+        writes = self._writes
+        self._writes, self._size = [], 0
+        if not writes:
+            return
+        try:
+            await self._store([transition for transitions, _ in writes for transition in transitions])
+        except Exception as e:
+            logger.warning(f"Storing a batch of {len(writes)} writes failed, storing them one by one: {e!r}")
+        else:
+            for _, waiter in writes:
+                self._resolve(waiter)
+            return
+        for transitions, waiter in writes:
+            try:
+                await self._store(transitions)
+            except Exception as e:
+                self._resolve(waiter, e)
+            else:
+                self._resolve(waiter)
+
+    @staticmethod
+    def _resolve(waiter: asyncio.Future, error: Exception | None = None):
+        if waiter.done():
+            return
+        if error is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(error)
+
+    async def close(self):
+        """Store everything still buffered, called on shutdown"""
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+write_behind_settings = WriteBehindSettings()
+status_writes = StatusWriteBuffer(
+    write_behind_settings.write_behind_enabled,
+    write_behind_settings.write_behind_delay_ms / 1000,
+    write_behind_settings.write_behind_max_batch,
+    write_behind_settings.write_behind_retries,
+    write_behind_settings.write_behind_retry_delay_ms / 1000
+)
@@ -0,0 +1,57 @@
+"""Fixtures of the Postgres-backed tests.
+
+The tests empty every table, so they only run against a database named by
+TEST_POSTGRES_DB (created when missing); the other POSTGRES_* settings are
+read as usual. Without it, or with Postgres unreachable, the tests are skipped.
+"""
+import os
+
+TEST_DATABASE = os.environ.get("TEST_POSTGRES_DB")
+if TEST_DATABASE:
+    # Read by the app settings on import, so it is set before any app module is loaded
+    os.environ["POSTGRES_DB"] = TEST_DATABASE
+
+import asyncpg
+import pytest
+from sqlalchemy import text
+
+from app.db.base import Base, engine, init_models
+from app.db.create import connect_create_if_not_exists, settings
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # Session wide, so every test runs on the event loop the app's engine is bound to
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def database(anyio_backend):
+    if not TEST_DATABASE:
+        pytest.skip("TEST_POSTGRES_DB is not set")
+    try:
+        conn = await asyncpg.connect(
+            user=settings.postgres_user,
+            password=settings.postgres_password,
+            host=settings.postgres_host,
+            database='template1',
+            timeout=5
+        )
+    except (OSError, asyncpg.PostgresError) as e:
+        pytest.skip(f"Postgres is unreachable: {e!r}")
+    await conn.close()
+    await connect_create_if_not_exists(
+        settings.postgres_user, settings.postgres_db, settings.postgres_password, settings.postgres_host
+    )
+    await init_models()
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture
+async def db(database):
+    """The database with every table emptied before the test"""
+    tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+    async with database.begin() as conn:
+        await conn.execute(text(f"TRUNCATE {tables} CASCADE"))
+    return database
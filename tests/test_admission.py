@@ -0,0 +1,39 @@
+import pytest
+from fastapi import HTTPException
+
+from app.repositories.image import ImageRepository
+from app.schemas.ai import AIModel
+from app.services.admission import AdmissionController, admission_settings
+
+pytestmark = pytest.mark.anyio
+
+MODEL = AIModel.flux_schnell.value
+
+
+async def queue(count: int):
+    async with ImageRepository() as image_repository:
+        await image_repository.create_many([
+            dict(app_bundle="bundle", user_id="user", prompt="a cat", image_size="square", model=MODEL)
+            for _ in range(count)
+        ])
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(admission_settings, "admission_enabled", True)
+    monkeypatch.setattr(admission_settings, "admission_min_queue_depth", 3)
+    monkeypatch.setattr(admission_settings, "admission_max_queue_depth", 100)
+
+
+async def test_short_queue_is_admitted_without_throughput(db, limits):
+    await queue(2)
+    assert await AdmissionController().admit() is None
+
+
+async def test_stalled_queue_is_rejected(db, limits):
+    # Nothing was submitted within the throughput window
+    await queue(5)
+    with pytest.raises(HTTPException) as error:
+        await AdmissionController().admit()
+    assert error.value.status_code == admission_settings.admission_status_code
+    assert error.value.headers["Retry-After"] == str(admission_settings.admission_retry_after_seconds)
@@ -0,0 +1,332 @@
+import asyncio
+import datetime as dt
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import func, select, update
+
+from app.db.tables import Image, ImageCallback, ImageStatus
+from app.repositories.ai import AIRepository
+from app.repositories.image import ImageRepository
+from app.schemas.ai import AIModel, AIOutputSchema
+from app.services.image import ImageService
+from app.services.write_behind import StatusWriteBuffer
+
+pytestmark = pytest.mark.anyio
+
+MODEL = AIModel.flux_schnell.value
+LEASE = dt.timedelta(minutes=5)
+# Long enough that no image is aged into a higher lane while a test runs
+AGING = dt.timedelta(days=1)
+FIELDS = dict(app_bundle="bundle", user_id="user", prompt="a cat", image_size="square", model=MODEL)
+
+
+class FakeAI:
+    """Stands in for the fal client, answers every submit with `response` or raises it"""
+
+    def __init__(self, response: str | Exception):
+        self.response = response
+        self.submitted = []
+
+    async def submit(self, request, image_id: str) -> str:
+        self.submitted.append(request)
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+
+async def add(**fields) -> Image:
+    async with ImageRepository() as image_repository:
+        return await image_repository.create(**FIELDS | fields)
+
+
+async def load(*images: Image) -> list[Image]:
+    async with ImageRepository() as image_repository:
+        by_id = {image.id: image for image in await image_repository.list_by_ids([image.id for image in images])}
+    return [by_id[image.id] for image in images]
+
+
+async def claim(count: int, bundle_weights: dict[str, float] | None = None) -> set:
+    async with ImageRepository() as image_repository:
+        images = await image_repository.claim_unsended(MODEL, count, LEASE, AGING, bundle_weights)
+        await image_repository.commit()
+    return {image.id for image in images}
+
+
+async def status_counts() -> dict:
+    async with ImageRepository() as image_repository:
+        rows = await image_repository.session.execute(select(Image.status, func.count()).group_by(Image.status))
+    return dict(list(rows))
+
+
+async def test_claim_leases_images(db):
+    image = await add()
+    assert await claim(5) == {image.id}
+    assert await claim(5) == set()
+
+    [image] = await load(image)
+    assert image.status == ImageStatus.submitting
+    assert image.lease_expires_at is not None
+
+
+async def test_expired_leases_free_their_slots(db, monkeypatch):
+    ai = FakeAI("request-1")
+    monkeypatch.setattr(AIRepository, "submit", lambda self, *args: ai.submit(*args))
+    for _ in range(7):
+        await add()
+    await claim(5)
+    # The worker holding the claims died before storing the submit results
+    async with ImageRepository() as image_repository:
+        await image_repository.session.execute(
+            update(Image)
+            .where(Image.status == ImageStatus.submitting)
+            .values(lease_expires_at=func.now() - dt.timedelta(hours=1))
+        )
+        assert await image_repository.count_generating_images() == {}
+        await image_repository.commit()
+
+    await ImageService.process_images_queue()
+
+    assert len(ai.submitted) == 5
+    assert await status_counts() == {ImageStatus.queued: 5, None: 2}
+
+
+async def test_claim_shares_slots_between_bundles_and_users(db):
+    busy = [await add(app_bundle="busy", user_id="u1") for _ in range(3)]
+    other_user = await add(app_bundle="busy", user_id="u2")
+    quiet = await add(app_bundle="quiet", user_id="u3")
+
+    # Oldest first would give every slot to the first user of the busy bundle
+    assert await claim(3) == {busy[0].id, quiet.id, other_user.id}
+    # The claimed images are in flight and count as turns taken, so a newer image of the quiet bundle goes first
+    later = await add(app_bundle="quiet", user_id="u4")
+    assert await claim(1) == {later.id}
+
+
+async def test_claim_follows_bundle_weights(db):
+    heavy = [await add(app_bundle="heavy", user_id=f"u{i}") for i in range(4)]
+    light = [await add(app_bundle="light", user_id=f"v{i}") for i in range(4)]
+    assert await claim(4, {"heavy": 2}) == {heavy[0].id, heavy[1].id, heavy[2].id, light[0].id}
+
+
+async def test_claim_takes_higher_lanes_first(db):
+    low = await add()
+    high = await add(priority=5)
+    assert await claim(1) == {high.id}
+    assert await claim(1) == {low.id}
+
+
+async def test_claim_ages_low_lanes(db):
+    old = await add()
+    high = await add(priority=1)
+    async with ImageRepository() as image_repository:
+        await image_repository.session.execute(
+            update(Image).where(Image.id == old.id).values(created_at=func.now() - dt.timedelta(minutes=3))
+        )
+        await image_repository.commit()
+        # Waiting 3 agings lifts the bulk image over the newer lane 1 image
+        images = await image_repository.claim_unsended(MODEL, 1, LEASE, dt.timedelta(minutes=1))
+        await image_repository.commit()
+    assert [image.id for image in images] == [old.id]
+    assert await claim(1) == {high.id}
+
+
+async def test_submit_stores_request_and_output_index(db):
+    first, second = await add(), await add()
+    assert await claim(2) == {first.id, second.id}
+    ai = FakeAI("request-1")
+
+    await ImageService(ai_repository=ai)._send([first, second])
+
+    first, second = await load(first, second)
+    assert ai.submitted[0].num_images == 2
+    assert (first.status, first.request_id, first.output_index) == (ImageStatus.queued, "request-1", 0)
+    assert (second.status, second.request_id, second.output_index) == (ImageStatus.queued, "request-1", 1)
+    assert first.lease_expires_at is None
+
+
+async def test_batch_images_share_a_request(db, monkeypatch):
+    ai = FakeAI("request-1")
+    monkeypatch.setattr(AIRepository, "submit", lambda self, *args: ai.submit(*args))
+    batch_id = uuid4()
+    async with ImageRepository() as image_repository:
+        images = await image_repository.create_many([FIELDS | dict(batch_id=batch_id) for _ in range(4)])
+
+    await ImageService.process_images_queue()
+
+    assert [request.num_images for request in ai.submitted] == [4]
+    images = await load(*images)
+    assert sorted(image.output_index for image in images) == [0, 1, 2, 3]
+    assert {image.request_id for image in images} == {"request-1"}
+
+
+async def test_failed_submit_stores_error(db):
+    image = await add()
+    await claim(1)
+
+    await ImageService(ai_repository=FakeAI(RuntimeError("fal is down")))._send([image])
+
+    [image] = await load(image)
+    assert (image.status, image.comment, image.request_id) == (ImageStatus.error, "fal is down", None)
+    assert image.lease_expires_at is None
+
+
+async def test_write_transitions_mixed_batch(db):
+    leader = await add(cache_key="key")
+    follower = await add(cache_key="key", leader_id=leader.id)
+    failing = await add(callback_url="http://example.com/done")
+    cancelled = await add(status=ImageStatus.error, comment="Cancelled")
+    await claim(2)
+
+    async with ImageRepository() as image_repository:
+        await image_repository.write_transitions([
+            dict(id=leader.id, status=ImageStatus.queued, request_id="request-2", output_index=0),
+            dict(id=failing.id, status=ImageStatus.error, comment="Timeout"),
+            dict(id=cancelled.id, status=ImageStatus.queued, request_id="request-3", output_index=0),
+        ])
+
+    leader, follower, failing, cancelled = await load(leader, follower, failing, cancelled)
+    assert (leader.status, leader.request_id) == (ImageStatus.queued, "request-2")
+    assert (follower.status, follower.request_id) == (ImageStatus.queued, "request-2")
+    assert (failing.status, failing.comment) == (ImageStatus.error, "Timeout")
+    # Cancelled while being submitted, it stays done
+    assert (cancelled.status, cancelled.request_id) == (ImageStatus.error, None)
+    async with ImageRepository() as image_repository:
+        callbacks = list(await image_repository.session.scalars(select(ImageCallback.image_id)))
+    assert callbacks == [failing.id]
+
+
+async def test_write_buffer_isolates_a_bad_write(db):
+    good, bad = await add(), await add()
+    await claim(2)
+    buffer = StatusWriteBuffer(enabled=True, delay=0.01, max_batch=100, retries=1, retry_delay=0)
+
+    results = await asyncio.gather(
+        buffer.write([dict(id=good.id, status=ImageStatus.queued, request_id="request-1", output_index=0)]),
+        buffer.write([dict(id=bad.id, status=ImageStatus.queued, request_id="request-2", output_index="first")]),
+        return_exceptions=True
+    )
+    await buffer.close()
+
+    assert results[0] is None
+    assert isinstance(results[1], Exception)
+    good, bad = await load(good, bad)
+    assert (good.status, good.request_id) == (ImageStatus.queued, "request-1")
+    assert bad.status == ImageStatus.submitting
+
+
+def webhook(request_id: str, **body) -> AIOutputSchema:
+    return AIOutputSchema.model_validate(dict(status="OK", request_id=request_id) | body)
+
+
+def images_output(request_id: str, *heights: int) -> AIOutputSchema:
+    return webhook(request_id, payload=dict(seed=7, images=[
+        dict(url=f"http://fal/{index}.jpg", width=512, height=height) for index, height in enumerate(heights)
+    ]))
+
+
+async def deliver(output: AIOutputSchema, image: Image):
+    async with ImageRepository() as image_repository:
+        service = await ImageService._in_session(image_repository)
+        await service.store_ai_output(output, image.id)
+
+
+async def test_webhook_finishes_every_image_of_the_request(db):
+    first = await add(status=ImageStatus.queued, request_id="request-4", output_index=0)
+    second = await add(
+        status=ImageStatus.queued, request_id="request-4", output_index=1, callback_url="http://example.com/done"
+    )
+    output = images_output("request-4", 512, 768)
+
+    async with ImageRepository() as image_repository:
+        rows = await image_repository.finish_request("request-4", output)
+    assert {row.id for row in rows} == {first.id, second.id}
+
+    first, second = await load(first, second)
+    assert (first.status, first.image_url, first.height) == (ImageStatus.finished, "http://fal/0.jpg", 512)
+    assert (second.status, second.image_url, second.height) == (ImageStatus.finished, "http://fal/1.jpg", 768)
+    assert first.seed == second.seed == 7
+
+    # A repeated delivery changes nothing and queues no second callback
+    async with ImageRepository() as image_repository:
+        assert await image_repository.finish_request("request-4", output) == []
+        callbacks = list(await image_repository.session.scalars(select(ImageCallback.image_id)))
+    assert callbacks == [second.id]
+
+
+async def test_failed_webhook_stores_error(db):
+    image = await add(status=ImageStatus.queued, request_id="request-5")
+
+    await deliver(webhook("request-5", status="ERROR", error="NSFW content"), image)
+
+    [image] = await load(image)
+    assert (image.status, image.comment, image.image_url) == (ImageStatus.error, "NSFW content", None)
+
+
+async def test_webhook_before_the_submit_result(db):
+    first, second = await add(), await add()
+    await claim(2)
+
+    # fal answers before the submit result of the images is stored
+    await deliver(images_output("request-6", 512, 768), first)
+    [first] = await load(first)
+    assert first.status == ImageStatus.submitting
+
+    async with ImageRepository() as image_repository:
+        await image_repository.write_transitions([
+            dict(id=first.id, status=ImageStatus.queued, request_id="request-6", output_index=0),
+            dict(id=second.id, status=ImageStatus.queued, request_id="request-6", output_index=1),
+        ])
+
+    first, second = await load(first, second)
+    assert (first.status, first.image_url) == (ImageStatus.finished, "http://fal/0.jpg")
+    assert (second.status, second.image_url) == (ImageStatus.finished, "http://fal/1.jpg")
+
+
+async def test_failed_webhook_before_the_submit_result(db):
+    image = await add()
+    await claim(1)
+
+    await deliver(webhook("request-7", status="ERROR", error="NSFW content"), image)
+    async with ImageRepository() as image_repository:
+        await image_repository.write_transitions([
+            dict(id=image.id, status=ImageStatus.queued, request_id="request-7", output_index=0)
+        ])
+
+    [image] = await load(image)
+    assert (image.status, image.comment) == (ImageStatus.error, "NSFW content")
+
+
+async def test_cancelled_submitting_leader_hands_its_request_to_followers(db):
+    leader = await add(cache_key="key")
+    await claim(1)
+    follower = await add(cache_key="key", leader_id=leader.id)
+    async with ImageRepository() as image_repository:
+        await image_repository.cancel(leader.id)
+
+    # The follower is not submitted again while the leader's submit is running
+    assert await claim(5) == set()
+    async with ImageRepository() as image_repository:
+        await image_repository.write_transitions([
+            dict(id=leader.id, status=ImageStatus.queued, request_id="request-8", output_index=0)
+        ])
+
+    leader, follower = await load(leader, follower)
+    assert (leader.status, leader.comment, leader.request_id) == (ImageStatus.error, "Cancelled", None)
+    assert (follower.status, follower.request_id) == (ImageStatus.queued, "request-8")
+
+
+async def test_followers_of_a_cancelled_lost_submit_get_a_new_leader(db):
+    leader = await add(cache_key="key")
+    await claim(1)
+    follower = await add(cache_key="key", leader_id=leader.id)
+    async with ImageRepository() as image_repository:
+        await image_repository.cancel(leader.id)
+        # The worker submitting the leader died
+        await image_repository.session.execute(
+            update(Image).where(Image.id == leader.id).values(lease_expires_at=func.now() - dt.timedelta(hours=1))
+        )
+        await image_repository.promote_orphans()
+        await image_repository.commit()
+
+    assert await claim(5) == {follower.id}